@@ -9,7 +9,7 @@ __author__ = 'Qinv'
 JSON API definition.
 '''
 
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64
 
 class APIError(Exception):
     '''
@@ -42,14 +42,33 @@ class APIPermissionError(APIError):
     def __init__(self, message=''):
         super(APIPermissionError, self).__init__('permission:forbidden', 'permission', message)
 
+# 游标是排序列取值的列表,经json和base64编码后对客户端不透明
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8'))
+    except (ValueError, TypeError) as e:
+        raise APIValueError('cursor', 'Invalid cursor.')
+    # 游标由客户端传回,只接受(排序列的值, 主键)两个标量,其他内容不能作为SQL参数
+    if not isinstance(values, list) or len(values) != 2:
+        raise APIValueError('cursor', 'Invalid cursor.')
+    for v in values:
+        if isinstance(v, bool) or not isinstance(v, (str, int, float)):
+            raise APIValueError('cursor', 'Invalid cursor.')
+    return tuple(values)
+
 # 储存博客的分页信息
 class Page(object):
 
-    def __init__(self, item_count, page_index=1, page_size=10):
+    # exact=False表示item_count是缓存或估算的行数,页数仅供参考
+    def __init__(self, item_count, page_index=1, page_size=10, cursor=None, exact=True):
         self.item_count = item_count
+        self.exact = exact
         self.page_size = page_size
         self.page_count = item_count // page_size + (1 if item_count % page_size > 0 else 0)
-        if (item_count == 0) or (page_index > self.page_count):
+        if (item_count == 0) or (exact and page_index > self.page_count):
             self.offset = 0
             self.limit = 0
             self.page_index = 1
@@ -59,9 +78,25 @@ class Page(object):
             self.limit = self.page_size
         self.has_next = self.page_index < self.page_count
         self.has_previous = self.page_index > 1
+        # 游标分页: cursor是上一页返回的next, after是解码后传给findAll的seek位置
+        self.cursor = cursor
+        self.after = decode_cursor(cursor) if cursor else None
+        self.next = None
+        if cursor:
+            self.has_previous = True
+
+    def seek(self, items, *keys):
+        '''
+        Trim items queried with limit=page_size+1 to one page and set the next cursor from the keys of the last item.
+        '''
+        if len(items) > self.page_size:
+            items = items[:self.page_size]
+            self.next = encode_cursor([items[-1][k] for k in keys])
+        self.has_next = self.next is not None
+        return items
 
     def __str__(self):
-        return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % (self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
+        return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s, exact: %s' % (self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit, self.exact)
 
     __repr__ = __str__
 
@@ -2,11 +2,13 @@
 #!/usr/bin/env python
 import logging; logging.basicConfig(level=logging.INFO)
 
-import asyncio, os, json, time
+import asyncio, os, json, time, signal
 from datetime import datetime
 
 from aiohttp import web
 import orm
+from models import User, Blog, Comment
+from config import configs
 from jinja2 import Environment, FileSystemLoader
 from coroweb import add_routes, add_static
 
@@ -59,6 +61,36 @@ def auth_factory(app, handler):
 
 
 
+# 每个请求绑定一个identity map,同一请求内重复的Model.find(pk)直接复用已加载的实例
+@asyncio.coroutine
+def identity_map_factory(app, handler):
+    @asyncio.coroutine
+    def identity_map(request):
+        token = orm.bind_identity_map()
+        try:
+            return (yield from handler(request))
+        finally:
+            orm.reset_identity_map(token)
+    return identity_map
+
+# 每个请求的数据库操作必须在configs.db.request_timeout秒内完成,超时的查询被取消、连接被关闭,
+# 等不到连接返回503,查询超时返回504
+@asyncio.coroutine
+def deadline_factory(app, handler):
+    @asyncio.coroutine
+    def deadline(request):
+        token = orm.set_deadline(configs.db.request_timeout)
+        try:
+            return (yield from handler(request))
+        except orm.DeadlineExceeded as e:
+            logging.warning('%s %s: %s' % (request.method, request.path, e))
+            if e.stage == 'pool':
+                return web.Response(status=503, text='Service Unavailable', headers={'Retry-After': '1'})
+            return web.Response(status=504, text='Gateway Timeout')
+        finally:
+            orm.reset_deadline(token)
+    return deadline
+
 @asyncio.coroutine
 def logger_factory(app, handler):
     @asyncio.coroutine
@@ -113,7 +145,7 @@ def response_factory(app, handler):
             template = r.get('__template__')
             
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o._asdict() if isinstance(o, orm.Row) else o.__dict__).encode('utf-8'))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
@@ -157,10 +189,20 @@ def datetime_filter(t):
 
 @asyncio.coroutine
 def init(loop):
-    yield from orm.create_pool(loop=loop, host='127.0.0.1', port=3306, user='root', password='220016', db='awesome')
+    pool = dict(maxsize=configs.db.maxsize, minsize=configs.db.minsize, warmup=configs.db.warmup, ping_interval=configs.db.ping_interval, max_lifetime=configs.db.max_lifetime)
+    if configs.db.backend == 'sqlite':
+        # 嵌入式SQLite用于本机压测和测试,启动时按模型建表
+        yield from orm.create_pool(loop=loop, backend='sqlite', db=configs.db.database, **pool)
+        yield from orm.create_tables(User, Blog, Comment)
+    else:
+        yield from orm.create_pool(loop=loop, host='127.0.0.1', port=3306, user='root', password='220016', db='awesome', explain=configs.db.explain, **pool)
+    if configs.db.write_buffer:
+        orm.enable_write_buffer(interval=configs.db.write_buffer)
+    # 连接池预热完成后才开始监听,避免第一批请求承担建连耗时
+    yield from orm.wait_ready()
     
     app = web.Application(loop=loop, middlewares=[
-        logger_factory, response_factory
+        logger_factory, identity_map_factory, deadline_factory, response_factory
     ])
     
     # 初始化jinja2模板
@@ -174,4 +216,11 @@ def init(loop):
 
 loop = asyncio.get_event_loop()
 loop.run_until_complete(init(loop))
-loop.run_forever()
\ No newline at end of file
+loop.add_signal_handler(signal.SIGTERM, loop.stop)
+try:
+    loop.run_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    # 退出前写完写缓冲中的数据并关闭连接池
+    loop.run_until_complete(orm.destroy_pool())
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# bench_orm.py
+# ORM每行开销的微基准: 对比逐列getattr/关键字参数展开的旧写法和元类生成的构造、参数提取函数
+# 用法: python3 bench_orm.py              只测纯Python部分,不连接数据库
+#       python3 bench_orm.py --sqlite     另外在嵌入式SQLite上测findAll的端到端耗时
+
+import sys, time, timeit, asyncio
+
+import orm
+from models import Blog
+
+ROWS = 1000
+REPEAT = 5
+
+def make_rows(n):
+    return [dict(id='%050d' % i, user_id='u', user_name='name', user_image='image', name='blog %s' % i, summary='summary',
+                 comment_count=0, view_count=0, created_at=time.time()) for i in range(n)]
+
+def per_row(fn, n):
+    # 取多次运行中最快的一次,换算成每行微秒
+    return min(timeit.repeat(fn, number=1, repeat=REPEAT)) / n * 1e6
+
+def report(name, old, new):
+    print('%-24s %8.3f us/row -> %8.3f us/row  (%.1fx)' % (name, old, new, old / new if new else 0.0))
+
+def bench_python():
+    rows = make_rows(ROWS)
+    objs = [Blog.__from_row__(r) for r in rows]
+    for o in objs:
+        o.content = 'content'
+    fields, pk = Blog.__fields__, Blog.__primary_key__
+    updatable = Blog.__updatable__
+
+    def construct_old():
+        return [Blog(**r) for r in rows]
+    def construct_new():
+        return list(map(Blog.__from_row__, rows))
+    def insert_old():
+        for o in objs:
+            args = list(map(o.getValueOrDefault, fields))
+            args.append(o.getValueOrDefault(pk))
+    def insert_new():
+        for o in objs:
+            o.__insert_args__()
+    def update_old():
+        for o in objs:
+            args = list(map(o.getValue, updatable))
+            args.append(o.getValue(pk))
+    def update_new():
+        for o in objs:
+            o.__update_args__()
+
+    assert construct_old() == construct_new()
+    assert [o.__insert_args__() for o in objs] == [list(map(o.getValueOrDefault, fields)) + [o.getValueOrDefault(pk)] for o in objs]
+    report('construct from row', per_row(construct_old, ROWS), per_row(construct_new, ROWS))
+    report('save arguments', per_row(insert_old, ROWS), per_row(insert_new, ROWS))
+    report('update arguments', per_row(update_old, ROWS), per_row(update_new, ROWS))
+
+@asyncio.coroutine
+def bench_sqlite(loop):
+    yield from orm.create_pool(loop=loop, backend='sqlite', db='bench', ping_interval=0)
+    try:
+        yield from orm.create_tables(Blog)
+        blogs = [Blog(content='content', **r) for r in make_rows(ROWS)]
+        yield from Blog.save_many(blogs)
+        best = None
+        for _ in range(REPEAT):
+            start = time.perf_counter()
+            rs = yield from Blog.findAll()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print('%-24s %8.3f us/row  (%s rows, sqlite in memory)' % ('findAll end to end', best / len(rs) * 1e6, len(rs)))
+    finally:
+        yield from orm.destroy_pool()
+
+if __name__ == '__main__':
+    bench_python()
+    if '--sqlite' in sys.argv[1:]:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(bench_sqlite(loop))
+        loop.close()
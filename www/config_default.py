@@ -8,13 +8,25 @@
 
 configs = {
     'db': {
+        'backend': 'mysql', # 改为'sqlite'时使用嵌入式SQLite,database为内存数据库名或.db文件路径
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'root',
         'password': '220016',
-        'database': 'awesome'
+        'database': 'awesome',
+        'explain': True, # 每种查询第一次执行时EXPLAIN,发现全表扫描和filesort时警告
+        'maxsize': 10, # 连接池上限,根据/api/metrics/pool中的exhausted和wait_avg调整
+        'minsize': 1, # 连接池保持的最少连接数
+        'warmup': 5, # 启动时预先建立的连接数,预热完成后才开始监听
+        'ping_interval': 30, # 后台检查空闲连接的间隔(秒),0为关闭
+        'max_lifetime': 3600, # 连接存活超过该秒数后在归还时关闭重建,避免被MySQL的wait_timeout断开
+        'write_buffer': 1.0, # 阅读数等写入经写缓冲合并后每隔该秒数批量写入,0为直接写入
+        'request_timeout': 10 # 每个请求的数据库操作总时限(秒),超时返回503/504,0为不限制
     },
     'session': {
         'secret': 'AwEsOmE'
+    },
+    'metrics': {
+        'pool_endpoint': True # 是否开放/api/metrics/pool查看连接池统计
     }
 }
\ No newline at end of file
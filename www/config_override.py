@@ -7,6 +7,10 @@
 
 configs = {
     'db': {
-        'host': '192.168.0.100'
+        'host': '192.168.0.100',
+        'explain': False
+    },
+    'metrics': {
+        'pool_endpoint': False
     }
 }
\ No newline at end of file
@@ -9,8 +9,9 @@ import re, time, json, logging, hashlib, base64, asyncio
 
 from coroweb import get, post
 import markdown2
+import orm
 from models import User, Comment, Blog, next_id
-from apis import APIValueError, APIResourceNotFoundError
+from apis import Page, APIValueError, APIResourceNotFoundError
 from config import configs
 
 _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
@@ -63,8 +64,10 @@ def index(request):
 @get('/blog/{id}')
 @asyncio.coroutine
 def get_blog(id):
-    blog = yield from Blog.find(id)
-    comments = yield from Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
+    blog, comments = yield from orm.gather(Blog.find(id, undefer=['content']), Comment.filter(blog_id=id).order_by('-created_at'))
+    if blog is None:
+        raise APIResourceNotFoundError('blog')
+    yield from orm.buffer_increment(Blog, id, 'view_count')
     for c in comments:
         c.html_content = text2html(c.content)
     blog.html_content = markdown2.markdown(blog.content)
@@ -77,14 +80,18 @@ def get_blog(id):
 # 博客分页
 @asyncio.coroutine
 @get('/api/blogs')
-def api_blogs(*, page='1'):
+def api_blogs(*, page='1', cursor=None):
     page_index = get_page_index(page)
-    num = yield from Blog.findNumber('count(id)')
-    p = Page(num, page_index)
+    num = yield from Blog.findNumber('count(id)', cached=True)
+    p = Page(num, page_index, cursor=cursor, exact=False)
     if num == 0:
         return dict(page=p, blogs=())
-    blogs = yield from Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
-    return dict(page=p, blogs=blogs)
+    if cursor is None and p.page_index > 1:
+        blogs = yield from Blog.filter().order_by('-created_at').limit(p.offset, p.limit)
+        return dict(page=p, blogs=blogs)
+    # 第一页和带cursor的请求走seek分页,多取一条判断是否还有下一页
+    blogs = yield from Blog.findAll(orderBy='created_at desc', after=p.after, limit=p.page_size + 1)
+    return dict(page=p, blogs=p.seek(blogs, 'created_at', 'id'))
 
 # 管理分页
 @get('/manage/blogs')
@@ -100,7 +107,7 @@ def manage_blogs(*, page='1'):
 @asyncio.coroutine
 @get('/api/users')
 def api_get_users():
-    users = yield from User.findAll(orderBy='created_at desc')
+    users = yield from User.filter().order_by('-created_at').all(compact=True)
     for u in users:
         u.passwd = '*****'
     return dict(users=users)
@@ -130,8 +137,8 @@ def api_register_user(*, email, name, passwd):
         raise APIValueError('email')
     if not passwd or not _RE_SHA1.match(passwd):
         raise APIValueError('passwd')
-    users = yield from User.findAll('email=?', [email])
-    if len(users) > 0:
+    user = yield from User.filter(email=email).first()
+    if user is not None:
         raise APIError('register:failed', 'email', 'Email is already in use.')
     uid = next_id()
     sha1_passwd = '%s:%s' % (uid, passwd)
@@ -153,10 +160,9 @@ def authenticate(*, email, passwd):
         raise APIValueError('email', 'Invalid email.')
     if not passwd:
         raise APIValueError('passwd', 'Invalid password.')
-    users = yield from User.findAll('email=?', [email])
-    if len(users) == 0:
+    user = yield from User.filter(email=email).first()
+    if user is None:
         raise APIValueError('email', 'Email not exist.')
-    user = users[0]
     # check passwd:
     sha1 = hashlib.sha1()
     sha1.update(user.id.encode('utf-8'))
@@ -202,6 +208,8 @@ def cookie2user(cookie_str):
         if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
             logging.info('invalid sha1')
             return None
+        # 身份映射中的实例在本次请求内共享,只在副本上隐藏口令,避免之后find到被改过的对象并把'******'写回数据库
+        user = User(**user)
         user.passwd = '******'
         return user
     except Exception as e:
@@ -250,6 +258,12 @@ def manage_create_blog():
 @get('/api/blogs/{id}')
 @asyncio.coroutine
 def api_get_blog(*, id):
-    blog = yield from Blog.find(id)
+    blog = yield from Blog.find(id, undefer=['content'])
     return blog
 
+# 连接池、查询缓存统计和EXPLAIN记录,用于调整maxsize、缓存大小和检查索引使用
+@get('/api/metrics/pool')
+def api_pool_metrics():
+    if not configs.metrics.pool_endpoint:
+        raise APIResourceNotFoundError('metrics')
+    return dict(pools=orm.pool_stats(), query_cache=orm.query_cache_stats(), explain=orm.explain_report(), write_buffer=orm.write_buffer_stats())
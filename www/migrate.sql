@@ -0,0 +1,10 @@
+-- migrate.sql
+-- 升级已有数据库的表结构,新建数据库直接使用schema.sql,不需要执行本文件
+-- 用法: mysql -u root -p awesome < migrate.sql (每段只执行一次,已经执行过的段落请删除或注释掉)
+
+-- blogs.comment_count: 由Comment的__counters__维护的评论数
+-- 执行后运行 python3 repair_counters.py 按comments表回填已有博客的评论数
+alter table blogs add column `comment_count` int not null default 0 after `content`;
+
+-- blogs.view_count: 阅读数,经写缓冲累加,已有博客从0开始计数
+alter table blogs add column `view_count` int not null default 0 after `comment_count`;
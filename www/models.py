@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 import time, uuid
 import orm
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, FloatField, TextField, CounterField, Index
 import asyncio, os, json, time
 import aiomysql
 
@@ -12,17 +12,19 @@ def next_id():
 
 class User(Model):
     __table__ = 'users'
+    __indexes__ = [Index('email', unique=True), Index('created_at')]
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     email = StringField(ddl='varchar(50)')
     passwd = StringField(ddl='varchar(50)')
-    admin = BooleanField()
+    admin = BooleanField(ddl='bool')
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, ddl='real')
 
 class Blog(Model):
     __table__ = 'blogs'
+    __indexes__ = [Index('created_at')]
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
@@ -30,19 +32,23 @@ class Blog(Model):
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    content = TextField(ddl='mediumtext', deferred=True) # 正文较大,列表页不查询
+    comment_count = CounterField() # 由Comment的__counters__维护
+    view_count = CounterField() # 阅读数,经写缓冲累加
+    created_at = FloatField(default=time.time, ddl='real')
 
 class Comment(Model):
     __table__ = 'comments'
+    __indexes__ = [Index('blog_id'), Index('created_at')]
+    __counters__ = [('blog_id', Blog, 'comment_count')]
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    content = TextField(ddl='mediumtext')
+    created_at = FloatField(default=time.time, ddl='real')
 
 
   
@@ -6,69 +6,1302 @@ __author__ = 'Qinv'
 import sys 
 import logging; 
 logging.basicConfig(level=logging.INFO)
-import asyncio, os, json, time
+import asyncio
+# 需要Python 3.7 - 3.10: contextvars从3.7开始提供,asyncio.coroutine在3.11中被移除
+if sys.version_info < (3, 7) or not hasattr(asyncio, 'coroutine'):
+    raise RuntimeError('orm requires Python 3.7 - 3.10, running %s.%s' % sys.version_info[:2])
+import os, json, time, contextvars, collections, weakref, unicodedata
 import aiomysql
 
 
 def log(sql,args=()):  
     logging.info('SQL:%s' %sql)  
 
+# 语句缓存的上限,防止拼接出的SQL过多导致缓存无限增长
+_MAX_STATEMENTS = 1024
+# 缓存转换成数据库驱动语法后的SQL,同一条语句每个进程只转换一次
+_translated = {}
+
+def translate(sql):
+    try:
+        return _translated[sql]
+    except KeyError:
+        pass
+    if len(_translated) >= _MAX_STATEMENTS:
+        _translated.clear()
+    _translated[sql] = s = _driver.translate(sql) if _driver is not aiomysql else sql.replace('?', '%s')
+    return s
+
+# 数据库驱动: 默认是aiomysql,create_pool(backend='sqlite')时换成提供相同接口的sqlite_backend
+_driver = aiomysql
+
+def backend():
+    return 'mysql' if _driver is aiomysql else 'sqlite'
+
 @asyncio.coroutine
 def create_pool(loop,**kw):
+    '''
+    Create the primary pool, plus one pool per entry of replicas=[{'host': ...}, ...] (keys not given are taken from kw).
+    warmup=N opens N connections per pool in the background (wait_ready() waits for it), ping_interval checks idle connections,
+    max_lifetime closes connections older than that many seconds when they are released.
+    '''
     logging.info('create database connection pool...') 
-    global __pool
-    __pool = yield from aiomysql.create_pool(
+    global __pool, __replicas, _replica_strategy, _read_your_writes, _driver, _max_lifetime, _warm_task
+    _ready_event().clear()
+    name = kw.get('backend', 'mysql')
+    if name == 'sqlite':
+        import sqlite_backend
+        _driver = sqlite_backend
+    elif name == 'mysql':
+        _driver = aiomysql
+    else:
+        raise ValueError('Invalid backend value : %s ' % name)
+    _translated.clear()
+    _pool_stats.clear()
+    __pool = yield from _create_pool(loop, kw)
+    _pool_stats[__pool] = PoolStats('primary', __pool)
+    __replicas = []
+    for r in kw.get('replicas', None) or ():
+        logging.info('create replica connection pool: %s' % r.get('host', kw.get('host', 'localhost')))
+        pool = yield from _create_pool(loop, dict(kw, **r))
+        _pool_stats[pool] = PoolStats('replica-%s' % len(__replicas), pool)
+        __replicas.append(pool)
+    _replica_strategy = kw.get('replica_strategy', 'round_robin')
+    if _replica_strategy not in ('round_robin', 'least_busy'):
+        raise ValueError('Invalid replica_strategy value : %s ' % _replica_strategy)
+    _read_your_writes = kw.get('read_your_writes', 1.0)
+    if kw.get('explain', False):
+        if _driver is aiomysql:
+            enable_explain()
+        else:
+            logging.warning('EXPLAIN capture needs the MySQL backend, ignored')
+    _max_lifetime = kw.get('max_lifetime', None)
+    # 预热在后台进行,连接池已经可以使用;需要等预热完成的调用方(app.init)调用wait_ready()
+    _warm_task = asyncio.ensure_future(_start(kw.get('warmup', kw.get('minsize', 1)), kw.get('ping_interval', 30)))
+
+@asyncio.coroutine
+def _start(warmup, interval):
+    global _health_task
+    for pool in [primary_pool()] + __replicas:
+        yield from warm_up(pool, warmup)
+    if interval:
+        _health_task = asyncio.ensure_future(_health_check(interval))
+    _ready_event().set()
+    logging.info('database connection pool ready')
+
+@asyncio.coroutine
+def _create_pool(loop, kw):
+    if _driver is not aiomysql:
+        return (yield from _driver.create_pool(db=kw.get('db', ':memory:'), maxsize=kw.get('maxsize',10), minsize=kw.get('minsize',1), loop=loop))
+    args = dict(
        host=kw.get('host','localhost'),
        port=kw.get('port',3306),
        user=kw['user'],
        password=kw['password'],
        db=kw['db'],
-       charset=kw.get('charset','utf8'),
+       charset=kw.get('charset','utf8'))
+    pool = yield from aiomysql.create_pool(
        autocommit=kw.get('autocommit',True),
        maxsize=kw.get('maxsize',10),
        minsize=kw.get('minsize',1),
-       loop=loop
+       pool_recycle=kw.get('pool_recycle',-1),
+       loop=loop,
+       **args
        )
+    _connect_args[pool] = args
+    return pool
     
 @asyncio.coroutine
 def destroy_pool():
+    global __pool, __replicas, _health_task, _warm_task
+    _ready_event().clear()
+    if _warm_task is not None:
+        _warm_task.cancel()
+        try:
+            yield from _warm_task
+        except BaseException:
+            pass
+        _warm_task = None
+    # 先写完写缓冲中的数据再关闭连接池
+    try:
+        yield from disable_write_buffer()
+    except Exception as e:
+        logging.exception('failed to flush write buffer on shutdown: %s' % e)
+    if _health_task is not None:
+        _health_task.cancel()
+        _health_task = None
+    for pool in [__pool] + __replicas:
+        if pool is not None:
+            pool.close() #关闭进程池,close不是协程
+            yield from pool.wait_closed() #wait_close()是一个协程
+    __replicas = []
+    _pool_stats.clear()
+
+# 连接池就绪信号: 后台预热完成后置位,app.init等待它之后才开始监听
+_ready = None
+_warm_task = None
+_health_task = None
+_max_lifetime = None
+# 连接第一次被借出的时间,用于按max_lifetime回收连接
+_born = weakref.WeakKeyDictionary()
+# 借出连接所属的连接池和各MySQL连接池的连接参数,超时后用来另开连接执行KILL QUERY
+_owner = weakref.WeakKeyDictionary()
+_connect_args = weakref.WeakKeyDictionary()
+
+def _ready_event():
+    global _ready
+    if _ready is None:
+        _ready = asyncio.Event()
+    return _ready
+
+def is_ready():
+    return _ready is not None and _ready.is_set()
+
+@asyncio.coroutine
+def wait_ready(timeout=None):
+    '''
+    Wait until the pools created by create_pool are warmed up; raises the error if warming up failed.
+    '''
+    if _warm_task is None:
+        raise RuntimeError('create_pool() has not been called')
+    yield from asyncio.wait_for(asyncio.shield(_warm_task), timeout)
+
+# 预热: 同时借出n个连接(不足的由连接池新建)并ping一次,然后全部归还,避免第一批请求承担建连耗时
+@asyncio.coroutine
+def warm_up(pool, n):
+    conns = []
+    try:
+        for _ in range(min(n, pool.maxsize)):
+            conns.append((yield from pool.acquire()))
+        for conn in conns:
+            yield from conn.ping(False)
+            _born.setdefault(conn, time.monotonic())
+    finally:
+        for conn in conns:
+            pool.release(conn)
+    logging.info('warmed up %s connections' % len(conns))
+
+# 后台健康检查: 定期借出空闲连接并ping,失败或超过max_lifetime的连接关闭后归还,连接池会丢弃它并在需要时重建
+@asyncio.coroutine
+def _health_check(interval):
+    while True:
+        yield from asyncio.sleep(interval)
+        for pool in [primary_pool()] + __replicas:
+            if pool is None:
+                continue
+            try:
+                yield from _ping_idle(pool)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning('health check failed: %s' % e)
+
+@asyncio.coroutine
+def _ping_idle(pool):
+    # 每次只借出一个空闲连接,检查完立即归还,检查期间请求仍能拿到其他空闲连接
+    seen = set()
+    for _ in range(pool.freesize):
+        if pool.freesize == 0:
+            break
+        conn = yield from pool.acquire()
+        try:
+            if conn in seen:
+                # 连接池又给出了刚检查过的连接,空闲连接都已检查过
+                break
+            seen.add(conn)
+            try:
+                yield from conn.ping(False)
+            except Exception as e:
+                logging.warning('close broken connection: %s' % e)
+                conn.close()
+                continue
+            if _expired(conn):
+                conn.close()
+        finally:
+            pool.release(conn)
+
+def _expired(conn):
+    if not _max_lifetime:
+        return False
+    born = _born.get(conn)
+    return born is not None and time.monotonic() - born > _max_lifetime
+
+__pool = None
+__replicas = []
+_replica_strategy = 'round_robin'
+_replica_index = 0
+# 当前请求最近一次写操作的时间,之后read_your_writes秒内的读也走主库,保证能读到自己刚写入的数据
+_read_your_writes = 1.0
+_last_write = contextvars.ContextVar('last_write', default=None)
+
+# 写操作和事务使用主库
+def primary_pool():
     global __pool
-    if __pool is not None:
-        __pool.close() #关闭进程池,close不是协程
-        yield from __pool.wait_closed() #wait_close()是一个协程
+    return __pool
+
+# 读操作: 没有配置从库或当前请求刚写过时走主库,否则按轮询或最少占用连接选择从库
+def replica_pool():
+    global __pool, __replicas, _replica_index
+    if not __replicas:
+        return __pool
+    last = _last_write.get()
+    if last is not None and time.time() - last < _read_your_writes:
+        return __pool
+    if _replica_strategy == 'least_busy':
+        return min(__replicas, key=lambda p: p.size - p.freesize)
+    _replica_index = (_replica_index + 1) % len(__replicas)
+    return __replicas[_replica_index]
         
+# 请求截止时间: app的中间件为每个请求设置,select/execute等在剩余时间内没有完成时取消并抛出DeadlineExceeded
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+class DeadlineExceeded(Exception):
+    '''
+    Raised when the request deadline passes; stage is 'pool' while waiting for a connection, 'query' while running a statement.
+    '''
+    def __init__(self, stage):
+        super().__init__('deadline exceeded while waiting for %s' % ('a connection' if stage == 'pool' else 'the query'))
+        self.stage = stage
+
+def set_deadline(seconds):
+    '''
+    Give the current request seconds to finish its queries, return a token for reset_deadline().
+    '''
+    return _deadline.set(time.monotonic() + seconds if seconds else None)
+
+def reset_deadline(token):
+    _deadline.reset(token)
+
+def remaining():
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+# 在截止时间前等待aw完成;超时时执行中的语句状态未知,关闭conn,归还后连接池会丢弃它
+# 只关闭连接时MySQL要等查询下次向客户端发送数据才会中止它,所以MySQL上另外在后台发送KILL QUERY取消服务端的查询
+@asyncio.coroutine
+def _before_deadline(aw, conn=None, stage=None):
+    deadline = _deadline.get()
+    if deadline is None:
+        return (yield from aw)
+    stage = stage or ('pool' if conn is None else 'query')
+    timeout = deadline - time.monotonic()
+    if timeout <= 0:
+        if hasattr(aw, 'close'):
+            aw.close()
+        raise DeadlineExceeded(stage)
+    try:
+        return (yield from asyncio.wait_for(aw, timeout))
+    except asyncio.TimeoutError:
+        if conn is not None:
+            pool = _owner.get(conn)
+            args = None if pool is None else _connect_args.get(pool)
+            if args is not None:
+                asyncio.ensure_future(_kill_query(args, conn.thread_id()))
+            conn.close()
+        raise DeadlineExceeded(stage) from None
+
+# 用单独的短连接取消thread_id上正在执行的语句;不占用连接池的名额,连接池耗尽时也能执行
+@asyncio.coroutine
+def _kill_query(args, thread_id):
+    try:
+        conn = yield from aiomysql.connect(connect_timeout=5, **args)
+        try:
+            cur = yield from conn.cursor()
+            yield from cur.execute('KILL QUERY %d' % thread_id)
+            yield from cur.close()
+        finally:
+            conn.close()
+    except Exception as e:
+        logging.warning('failed to kill query on connection %s: %s' % (thread_id, e))
+
+# 每个连接池的统计: 等待连接耗时、占用连接耗时、借出次数和连接池耗尽次数
+class PoolStats(object):
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.checkouts = 0
+        self.exhausted = 0
+        self.in_use = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+        self.released = 0
+
+    def snapshot(self):
+        return dict(
+            name=self.name,
+            size=self.pool.size,
+            free=self.pool.freesize,
+            in_use=self.in_use,
+            maxsize=self.pool.maxsize,
+            checkouts=self.checkouts,
+            exhausted=self.exhausted,
+            wait_avg=self.wait_total / self.checkouts if self.checkouts else 0.0,
+            wait_max=self.wait_max,
+            hold_avg=self.hold_total / self.released if self.released else 0.0,
+            hold_max=self.hold_max
+        )
+
+_pool_stats = dict()
+
+def pool_stats():
+    '''
+    Return a metrics snapshot (dict) for the primary pool and every replica pool.
+    '''
+    return [st.snapshot() for st in _pool_stats.values()]
+
+# 借出的连接,with块结束或调用release()时归还并记录占用时间
+class PooledConnection(object):
+
+    def __init__(self, pool, conn, stats):
+        self.pool = pool
+        self.conn = conn
+        self._stats = stats
+        self._acquired_at = time.monotonic()
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+    def release(self):
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return
+        hold = time.monotonic() - self._acquired_at
+        st = self._stats
+        st.in_use -= 1
+        st.released += 1
+        st.hold_total += hold
+        if hold > st.hold_max:
+            st.hold_max = hold
+        if _expired(conn):
+            conn.close()
+        return self.pool.release(conn)
+
+# 从连接池借出连接: with (yield from connection(pool)) as conn:
 @asyncio.coroutine
-def select(sql,args,size=None):
+def connection(pool):
+    st = _pool_stats.get(pool)
+    if st is None:
+        st = _pool_stats[pool] = PoolStats('pool-%s' % len(_pool_stats), pool)
+    if pool.freesize == 0 and pool.size >= pool.maxsize:
+        st.exhausted += 1
+    start = time.monotonic()
+    conn = yield from _before_deadline(pool.acquire())
+    _born.setdefault(conn, time.monotonic())
+    _owner[conn] = pool
+    wait = time.monotonic() - start
+    st.checkouts += 1
+    st.in_use += 1
+    st.wait_total += wait
+    if wait > st.wait_max:
+        st.wait_max = wait
+    return PooledConnection(pool, conn, st)
+
+# tuples=True时每行返回按SELECT列顺序的tuple,而不是dict
+@asyncio.coroutine
+def select(sql,args,size=None,tuples=False):
     log(sql,args)
-    global __pool
-    with (yield from __pool) as conn:
-        cur = yield from conn.cursor(aiomysql.DictCursor)
-        yield from cur.execute(sql.replace('?','%s'),args or ())
-        if size:
-            rs = yield from cur.fetchmany(size) #返回查询结果(条数为size),返回一个list
-        else:
-            rs = yield from cur.fetchall() #返回所有查询结果
-        yield from cur.close() #关闭游标
-        logging.info('rows returned: %s' %len(rs))
-        return rs
+    tx = _transaction.get()
+    if tx is not None:
+        return (yield from _before_deadline(_select(tx.conn, sql, args, size, tuples), tx.conn))
+    with (yield from connection(replica_pool())) as conn:
+        return (yield from _before_deadline(_select(conn, sql, args, size, tuples), conn))
+
+@asyncio.coroutine
+def _select(conn, sql, args, size, tuples):
+    if _explain and sql not in _explained:
+        yield from explain(conn, sql, args)
+    cur = yield from conn.cursor(_driver.Cursor if tuples else _driver.DictCursor)
+    yield from cur.execute(translate(sql),args or ())
+    if size:
+        rs = yield from cur.fetchmany(size) #返回查询结果(条数为size),返回一个list
+    else:
+        rs = yield from cur.fetchall() #返回所有查询结果
+    yield from cur.close() #关闭游标
+    logging.info('rows returned: %s' %len(rs))
+    return rs
+
+# 开发/测试环境使用: 每种SQL第一次执行时先运行EXPLAIN,记录访问类型、使用的索引和估计行数
+# 出现全表扫描(type=ALL)或filesort时输出警告
+_explain = False
+_explained = collections.OrderedDict() # SQL -> EXPLAIN结果
+
+def enable_explain():
+    global _explain
+    _explain = True
+
+def disable_explain():
+    global _explain
+    _explain = False
+
+def explain_report():
+    '''
+    Return the recorded EXPLAIN plans as a list of dict(sql, plan, warnings).
+    '''
+    return [dict(sql=sql, plan=e[0], warnings=e[1]) for sql, e in _explained.items()]
+
+@asyncio.coroutine
+def explain(conn, sql, args):
+    if len(_explained) >= _MAX_STATEMENTS:
+        _explained.popitem(last=False)
+    _explained[sql] = ([], []) # 先占位,避免并发时重复EXPLAIN
+    try:
+        cur = yield from conn.cursor(_driver.DictCursor)
+        yield from cur.execute('explain ' + translate(sql), args or ())
+        rs = yield from cur.fetchall()
+        yield from cur.close()
+    except Exception as e:
+        logging.warning('EXPLAIN failed for SQL: %s (%s)' % (sql, e))
+        return
+    plan = []
+    warnings = []
+    for r in rs:
+        r = dict((k.lower(), v) for k, v in r.items())
+        step = dict(table=r.get('table'), type=r.get('type'), key=r.get('key'), rows=r.get('rows'), extra=r.get('extra'))
+        plan.append(step)
+        if step['type'] == 'ALL':
+            warnings.append('full table scan on %s (rows: %s)' % (step['table'], step['rows']))
+        if step['extra'] and 'Using filesort' in step['extra']:
+            warnings.append('filesort on %s' % step['table'])
+    _explained[sql] = (plan, warnings)
+    for w in warnings:
+        logging.warning('EXPLAIN: %s in SQL: %s' % (w, sql))
 
 # 封装INSERT, UPDATE, DELETE  
 @asyncio.coroutine
 def execute(sql,args, autocommit=True):
     log(sql,args)
-    global __pool
-    with (yield from __pool) as conn:
+    _last_write.set(time.time())
+    tx = _transaction.get()
+    if tx is not None:
+        # 事务中的语句共用事务的连接,由事务统一提交
+        return (yield from _before_deadline(_execute_one(tx.conn, sql, args, False), tx.conn))
+    with (yield from connection(primary_pool())) as conn:
+        return (yield from _before_deadline(_execute_one(conn, sql, args, True), conn))
+
+@asyncio.coroutine
+def _execute_one(conn, sql, args, commit):
+    cur = yield from conn.cursor()
+    yield from cur.execute(translate(sql), args)
+    if commit:
+        yield from conn.commit()
+    affect_lines = cur.rowcount
+    yield from cur.close()
+    return affect_lines
+
+# 在同一个连接的一个事务中依次执行多条语句,返回每条语句影响的行数
+@asyncio.coroutine
+def execute_batch(statements):
+    _last_write.set(time.time())
+    tx = _transaction.get()
+    if tx is not None:
+        return (yield from _before_deadline(_execute_all(tx.conn, statements), tx.conn))
+    with (yield from connection(primary_pool())) as conn:
+        yield from conn.begin()
         try:
-            cur = yield from conn.cursor()
-            yield from cur.execute(sql.replace('?', '%s'), args)
+            rows = yield from _before_deadline(_execute_all(conn, statements), conn)
             yield from conn.commit()
-            affect_lines = cur.rowcount
-            yield from cur.close()
         except BaseException as e:
+            if not conn.closed:
+                yield from conn.rollback()
             raise
-        return affect_lines
-    
+        return rows
+
+@asyncio.coroutine
+def _execute_all(conn, statements):
+    cur = yield from conn.cursor()
+    rows = []
+    for sql, args in statements:
+        log(sql, args)
+        yield from cur.execute(translate(sql), args)
+        rows.append(cur.rowcount)
+    yield from cur.close()
+    return rows
+
+# 并发执行互不依赖的查询,每个查询使用各自的连接: blog, comments = yield from orm.gather(Blog.find(id), Comment.filter(blog_id=id))
+# 同时占用的连接数不超过limit(默认读连接池大小的一半),避免一个请求占满连接池;
+# 任何一个查询出错时取消其余查询并抛出该错误;事务中只有一个连接,按顺序执行
+@asyncio.coroutine
+def gather(*aws, limit=None):
+    '''
+    Run independent queries concurrently and return their results in argument order.
+    '''
+    if _transaction.get() is not None or len(aws) < 2:
+        results = []
+        for aw in aws:
+            results.append((yield from aw))
+        return results
+    if limit is None:
+        pool = replica_pool()
+        limit = max(1, pool.maxsize // 2) if pool is not None else len(aws)
+    sem = asyncio.Semaphore(limit)
+    @asyncio.coroutine
+    def run(aw):
+        yield from sem.acquire()
+        try:
+            return (yield from aw)
+        finally:
+            sem.release()
+    tasks = [asyncio.ensure_future(run(aw)) for aw in aws]
+    try:
+        return (yield from asyncio.gather(*tasks))
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        yield from asyncio.wait(tasks)
+        for t in tasks:
+            if not t.cancelled():
+                t.exception()
+        raise
+
+# 当前上下文中进行的事务,select/execute会使用事务固定的连接
+_transaction = contextvars.ContextVar('transaction', default=None)
+
+def transaction():
+    '''
+    Return a transaction to use as: async with orm.transaction() as tx: ...
+    All statements inside run on one primary connection and are committed together; nested transactions become savepoints.
+    '''
+    return Transaction()
+
+# 事务固定一个主库连接,正常退出时提交,异常时回滚;嵌套使用时用savepoint实现
+# 事务内不要并发执行查询(例如在事务中创建新的task),同一个连接不能同时执行多条语句
+class Transaction(object):
+
+    def __init__(self):
+        self.conn = None
+        self._lease = None
+        self._savepoint = None
+        self._savepoints = 0
+        self._tables = set() # 事务中修改过的表,提交后使查询缓存失效
+        self._token = None
+
+    @asyncio.coroutine
+    def __aenter__(self):
+        parent = _transaction.get()
+        if parent is not None:
+            root = parent._root()
+            root._savepoints += 1
+            self.conn = parent.conn
+            self._savepoint = 'sp_%s' % root._savepoints
+            yield from self._execute('savepoint `%s`' % self._savepoint)
+        else:
+            _last_write.set(time.time())
+            self._lease = yield from connection(primary_pool())
+            self.conn = self._lease.conn
+            try:
+                yield from self.conn.begin()
+            except BaseException as e:
+                self._lease.release()
+                raise
+        self._parent = parent
+        self._token = _transaction.set(self)
+        return self
+
+    @asyncio.coroutine
+    def __aexit__(self, exc_type, exc, tb):
+        _transaction.reset(self._token)
+        if self._savepoint is not None:
+            if exc_type is None:
+                yield from self._execute('release savepoint `%s`' % self._savepoint)
+            elif not self.conn.closed:
+                yield from self._execute('rollback to savepoint `%s`' % self._savepoint)
+            return False
+        try:
+            if exc_type is None:
+                try:
+                    yield from self.conn.commit()
+                except BaseException as e:
+                    yield from self.conn.rollback()
+                    raise
+            elif not self.conn.closed:
+                # 超过截止时间的语句会关闭连接,未提交的事务已被数据库回滚
+                yield from self.conn.rollback()
+        finally:
+            self._lease.release()
+            if _query_cache is not None:
+                for table in self._tables:
+                    _query_cache.invalidate(table)
+        return False
+
+    def _root(self):
+        tx = self
+        while tx._savepoint is not None:
+            tx = tx._parent
+        return tx
+
+    @asyncio.coroutine
+    def _execute(self, sql):
+        log(sql)
+        cur = yield from self.conn.cursor()
+        yield from cur.execute(sql)
+        yield from cur.close()
+
+# 请求范围的identity map: 同一请求内按(Model类, 主键)复用find()已加载的实例
+_identity_map = contextvars.ContextVar('identity_map', default=None)
+
+def bind_identity_map():
+    '''
+    Start an identity map for the current context (request), return the token for reset_identity_map().
+    '''
+    return _identity_map.set(dict())
+
+def reset_identity_map(token):
+    _identity_map.reset(token)
+
+def forget(model, pk):
+    im = _identity_map.get()
+    if im is not None:
+        im.pop((model, pk), None)
+
+# 合并同一轮事件循环中并发的Model.find(pk),用一条where pk in (?,?,...)查询后分发给各个调用者
+class BatchLoader(object):
+
+    def __init__(self, model, max_batch_size=100, delay=0):
+        self._model = model
+        self._max_batch_size = max_batch_size
+        self._delay = delay
+        self._pending = dict() # pk -> 等待该主键的future列表
+        self._primary = False # 批次中有请求刚写过数据,整批读主库
+        self._handle = None
+
+    def load(self, pk):
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        self._pending.setdefault(pk, []).append(fut)
+        last = _last_write.get()
+        if last is not None and time.time() - last < _read_your_writes:
+            self._primary = True
+        # 批量查询在空的上下文中执行,不继承第一个调用者的截止时间、写入时间等请求状态
+        if len(self._pending) >= self._max_batch_size:
+            if self._handle is not None:
+                self._handle.cancel()
+            contextvars.Context().run(self._dispatch)
+        elif self._handle is None:
+            if self._delay:
+                self._handle = loop.call_later(self._delay, self._dispatch, context=contextvars.Context())
+            else:
+                self._handle = loop.call_soon(self._dispatch, context=contextvars.Context())
+        return fut
+
+    def _dispatch(self):
+        self._handle = None
+        pending, self._pending = self._pending, dict()
+        primary, self._primary = self._primary, False
+        if pending:
+            asyncio.ensure_future(self._fetch(pending, primary))
+
+    @asyncio.coroutine
+    def _fetch(self, pending, primary):
+        cls = self._model
+        pks = list(pending.keys())
+        if primary:
+            _last_write.set(time.time())
+        try:
+            sql = cls.statement(('find_many', len(pks)), lambda: '%s where `%s` in (%s)' % (cls.__select__, cls.__primary_key__, create_args_string(len(pks))))
+            rs = yield from cached_select(cls.__table__, sql, pks)
+        except BaseException as e:
+            for futs in pending.values():
+                for fut in futs:
+                    if not fut.done():
+                        fut.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        found = dict()
+        for r in rs:
+            found[r[cls.__primary_key__]] = r
+        folded = None
+        for pk, futs in pending.items():
+            r = found.get(pk)
+            if r is None and isinstance(pk, str) and rs and _driver is aiomysql:
+                # MySQL按列的排序规则比较主键(忽略大小写、重音和末尾空格),逐条find能查到的记录这里也要能对上
+                if folded is None:
+                    folded = dict((_fold(k), v) for k, v in found.items() if isinstance(k, str))
+                r = folded.get(_fold(pk))
+            for fut in futs:
+                if not fut.done():
+                    # 每个调用者拿到独立的实例,和逐条find的行为一致
+                    fut.set_result(None if r is None else cls.__from_row__(r))
+
+# 近似MySQL *_general_ci排序规则的比较键
+def _fold(s):
+    s = unicodedata.normalize('NFKD', s.rstrip(' '))
+    return ''.join(c for c in s if not unicodedata.combining(c)).casefold()
+
+# 查询结果缓存: 按(SQL, 参数)缓存Model读取的结果,LRU淘汰并限制总字节数和存活时间
+# Model的save/update/delete等写操作会使对应表的缓存失效;直接调用orm.execute写入的数据不会自动失效
+class QueryCache(object):
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, ttl=60):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = collections.OrderedDict() # key -> (过期时间, 字节数, 表名, 结果)
+        self._tables = dict() # 表名 -> 该表的缓存key集合
+        self._generations = dict() # 表名 -> 失效次数,用于丢弃查询期间被失效的结果
+
+    def generation(self, table):
+        return self._generations.get(table, 0)
+
+    def get(self, key):
+        e = self._entries.get(key)
+        if e is None:
+            self.misses += 1
+            return None
+        if e[0] < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return e[3]
+
+    def put(self, table, key, rows, generation):
+        if generation != self.generation(table):
+            return
+        size = estimate_size(rows)
+        if size > self.max_bytes // 4:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, size, table, rows)
+        self._tables.setdefault(table, set()).add(key)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate(self, table):
+        self._generations[table] = self.generation(table) + 1
+        keys = self._tables.pop(table, None)
+        if keys:
+            self.invalidations += 1
+            for key in keys:
+                e = self._entries.pop(key, None)
+                if e is not None:
+                    self.bytes -= e[1]
+
+    def _remove(self, key):
+        e = self._entries.pop(key)
+        self.bytes -= e[1]
+        keys = self._tables.get(e[2])
+        if keys is not None:
+            keys.discard(key)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(entries=len(self._entries), bytes=self.bytes, max_bytes=self.max_bytes, ttl=self.ttl, hits=self.hits, misses=self.misses,
+                    hit_rate=self.hits / total if total else 0.0, evictions=self.evictions, invalidations=self.invalidations)
+
+# 粗略估计查询结果占用的字节数
+def estimate_size(rows):
+    size = sys.getsizeof(rows)
+    for r in rows:
+        size += sys.getsizeof(r)
+        for v in (r.values() if isinstance(r, dict) else r):
+            size += sys.getsizeof(v)
+    return size
+
+_query_cache = None
+
+def enable_query_cache(max_bytes=16 * 1024 * 1024, ttl=60):
+    '''
+    Cache the rows read by Model queries, up to max_bytes in total, each entry for at most ttl seconds.
+    '''
+    global _query_cache
+    _query_cache = QueryCache(max_bytes, ttl)
+
+def disable_query_cache():
+    global _query_cache
+    _query_cache = None
+
+def query_cache_stats():
+    return _query_cache.stats() if _query_cache is not None else None
+
+# 表被修改后调用: 使缓存失效,事务中还会在提交时再失效一次,防止其他请求在提交前缓存了旧数据
+def invalidate(table):
+    if _query_cache is not None:
+        _query_cache.invalidate(table)
+    tx = _transaction.get()
+    if tx is not None:
+        tx._root()._tables.add(table)
+
+# 经过查询缓存的select,事务中的读取不使用缓存
+@asyncio.coroutine
+def cached_select(table, sql, args, size=None, tuples=False):
+    cache = _query_cache
+    if cache is None or _transaction.get() is not None:
+        return (yield from select(sql, args, size, tuples))
+    key = (sql, tuple(args) if args else (), size, tuples)
+    rs = cache.get(key)
+    if rs is None:
+        generation = cache.generation(table)
+        rs = yield from select(sql, args, size, tuples)
+        cache.put(table, key, rs, generation)
+    return rs
+
+# 表行数计数器: findNumber('count(...)', cached=True)使用,Model插入和删除时增减,超过_COUNT_TTL秒后重新统计
+_COUNT_TTL = 300
+_row_counts = dict() # 表名 -> [行数, 过期时间]
+
+def adjust_count(table, delta):
+    if table not in _row_counts:
+        return
+    if delta is None or _transaction.get() is not None:
+        # 增量未知,或事务可能回滚,下次重新统计
+        _row_counts.pop(table, None)
+    else:
+        _row_counts[table][0] += delta
+
+_batching = None
+_loaders = dict()
+
+def enable_batching(max_batch_size=100, delay=0):
+    '''
+    Coalesce concurrent Model.find() calls into batched queries of at most max_batch_size keys, flushed after delay seconds (0 for the next loop iteration).
+    '''
+    global _batching
+    if not isinstance(max_batch_size, int) or max_batch_size < 1:
+        raise ValueError('Invalid max_batch_size value : %s ' % str(max_batch_size))
+    _batching = (max_batch_size, delay)
+    _loaders.clear()
+
+def disable_batching():
+    global _batching
+    _batching = None
+    _loaders.clear()
+
+def loader(model):
+    l = _loaders.get(model)
+    if l is None:
+        l = _loaders[model] = BatchLoader(model, *_batching)
+    return l
+
+# 写缓冲连续写入失败后重试间隔的上限(秒)
+_MAX_BACKOFF = 60
+
+# 写缓冲(write-behind): 浏览数、最后访问时间这类允许延迟的写入先在进程内按(模型, 主键)合并,
+# 每interval秒或积累到max_pending个键时用批量UPDATE写入;进程崩溃时缓冲中的数据会丢失,只适合不重要的数据
+class WriteBuffer(object):
+
+    def __init__(self, interval=1.0, max_pending=1000, batch_size=100, max_buffered=None):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        # 数据库长时间不可用时缓冲区的上限,超过后新记录的修改被丢弃并计入dropped
+        self.max_buffered = max_buffered or max_pending * 10
+        self.buffered = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.rows = 0
+        self.failures = 0
+        self.dropped = 0
+        self._retries = 0 # 连续失败次数,大于0时按退避间隔重试,不再因max_pending提前写入
+        self._pending = collections.OrderedDict() # (model, pk) -> {列: ('set', 值)或('incr', 增量)}
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    def add(self, model, pk, field, op, value):
+        key = (model, pk)
+        changes = self._pending.get(key)
+        if changes is None:
+            if len(self._pending) >= self.max_buffered:
+                self.dropped += 1
+                return
+            changes = self._pending[key] = dict()
+        elif field in changes:
+            self.coalesced += 1
+        prev = changes.get(field)
+        if op == 'incr' and prev is not None:
+            # 增量累加到之前的赋值或增量上
+            op, value = prev[0], prev[1] + value
+        changes[field] = (op, value)
+        self.buffered += 1
+        if len(self._pending) >= self.max_pending and not self._retries:
+            self._wakeup.set()
+
+    # 连续失败后重试间隔按2的幂增长,最长_MAX_BACKOFF秒
+    def _delay(self):
+        if not self._retries:
+            return self.interval
+        return min(self.interval * 2 ** self._retries, max(_MAX_BACKOFF, self.interval))
+
+    @asyncio.coroutine
+    def _run(self):
+        # 定时写入在创建缓冲区时的上下文中执行,不会进入调用add()的请求的事务
+        while True:
+            delay = self._delay()
+            if self._retries:
+                yield from asyncio.sleep(delay)
+            else:
+                try:
+                    yield from asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+            try:
+                yield from self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 只有第一次失败记录完整的异常栈,之后每次重试只记一行警告
+                if self._retries:
+                    logging.warning('failed to flush write buffer (%s pending, %s dropped), retrying in %.1fs: %s' % (len(self._pending), self.dropped, self._delay(), e))
+                else:
+                    logging.exception('failed to flush write buffer: %s' % e)
+                self._retries += 1
+            else:
+                if self._retries:
+                    logging.info('write buffer flushed after %s failed attempts' % self._retries)
+                self._retries = 0
+
+    @asyncio.coroutine
+    def flush(self):
+        '''
+        Write every pending change now, return the number of rows written.
+        '''
+        yield from self._lock.acquire()
+        try:
+            pending, self._pending = self._pending, collections.OrderedDict()
+            if not pending:
+                return 0
+            try:
+                rows = yield from write_changes(list(pending.items()), self.batch_size)
+            except BaseException:
+                # 写入失败时放回缓冲区,下次再写
+                self.failures += 1
+                self._restore(pending)
+                raise
+            self.flushes += 1
+            self.rows += len(pending)
+            return rows
+        finally:
+            self._lock.release()
+
+    # 把写入失败的修改合并回缓冲区: 失败期间新加入的赋值优先,增量累加
+    def _restore(self, pending):
+        for key, changes in pending.items():
+            current = self._pending.get(key)
+            if current is None:
+                if len(self._pending) >= self.max_buffered:
+                    self.dropped += 1
+                else:
+                    self._pending[key] = changes
+                continue
+            for field, (op, value) in changes.items():
+                newer = current.get(field)
+                if newer is None:
+                    current[field] = (op, value)
+                elif newer[0] == 'incr':
+                    current[field] = (op, value + newer[1])
+
+    @asyncio.coroutine
+    def close(self, retries=3):
+        self._task.cancel()
+        try:
+            yield from self._task
+        except asyncio.CancelledError:
+            pass
+        # 关闭时数据库短暂不可用也尽量写完,重试几次后才放弃
+        for i in range(retries):
+            try:
+                yield from self.flush()
+                return
+            except Exception as e:
+                if i == retries - 1:
+                    logging.error('dropping %s buffered records: %s' % (len(self._pending), e))
+                    raise
+                logging.warning('failed to flush write buffer, retrying: %s' % e)
+                yield from asyncio.sleep(0.5 * (i + 1))
+
+    def stats(self):
+        return dict(pending=len(self._pending), interval=self.interval, max_pending=self.max_pending, max_buffered=self.max_buffered,
+                    buffered=self.buffered, coalesced=self.coalesced, flushes=self.flushes, rows=self.rows, failures=self.failures,
+                    dropped=self.dropped, retry_in=self._delay() if self._retries else None)
+
+# 把[((model, pk), {列: (op, 值)}), ...]按(模型, 列和操作)分组,每组每batch_size行一条
+# update ... set `a` = case `id` when ? then ? ... end, `n` = `n` + case ... end where `id` in (...),在一个事务中执行
+@asyncio.coroutine
+def write_changes(items, batch_size=100):
+    groups = collections.OrderedDict()
+    for (model, pk), changes in items:
+        shape = tuple(sorted((f, op) for f, (op, v) in changes.items()))
+        groups.setdefault((model, shape), []).append((pk, changes))
+    statements = []
+    for (model, shape), rows in groups.items():
+        for i in range(0, len(rows), batch_size):
+            batch = rows[i:i + batch_size]
+            args = []
+            for field, op in shape:
+                for pk, changes in batch:
+                    args.extend((pk, changes[field][1]))
+            pks = [pk for pk, changes in batch]
+            args.extend(pks)
+            statements.append((_changes_sql(model, shape, len(batch)), args))
+            for pk in pks:
+                forget(model, pk)
+    rows = yield from execute_batch(statements)
+    for model in set(model for model, shape in groups):
+        invalidate(model.__table__)
+    return sum(rows)
+
+def _changes_sql(model, shape, n):
+    def build():
+        pk = model.__primary_key__
+        case = 'case `%s` %s end' % (pk, ' '.join(['when ? then ?'] * n))
+        sets = ['`%s` = %s' % (f, case) if op == 'set' else '`%s` = `%s` + %s' % (f, f, case) for f, op in shape]
+        return 'update `%s` set %s where `%s` in (%s)' % (model.__table__, ', '.join(sets), pk, create_args_string(n))
+    return model.statement(('changes', shape, n), build)
+
+_write_buffer = None
+
+def enable_write_buffer(interval=1.0, max_pending=1000, batch_size=100, max_buffered=None):
+    '''
+    Buffer buffer_update()/buffer_increment() writes, flushing them every interval seconds or once max_pending rows are waiting.
+    At most max_buffered rows (default 10 * max_pending) are kept while the database is failing; changes to further rows are dropped.
+    '''
+    global _write_buffer
+    if _write_buffer is not None:
+        raise RuntimeError('Write buffer already enabled')
+    _write_buffer = WriteBuffer(interval, max_pending, batch_size, max_buffered)
+
+@asyncio.coroutine
+def disable_write_buffer():
+    global _write_buffer
+    buf, _write_buffer = _write_buffer, None
+    if buf is not None:
+        yield from buf.close()
+
+@asyncio.coroutine
+def flush_writes():
+    if _write_buffer is not None:
+        return (yield from _write_buffer.flush())
+    return 0
+
+def write_buffer_stats():
+    return _write_buffer.stats() if _write_buffer is not None else None
+
+def _check_buffered(model, field):
+    if field not in model.__mappings__ or field == model.__primary_key__:
+        raise ValueError('Invalid column : %s ' % field)
+
+@asyncio.coroutine
+def buffer_update(model, pk, **values):
+    '''
+    Set columns of one record through the write buffer; written immediately when the buffer is disabled.
+    '''
+    for field in values:
+        _check_buffered(model, field)
+    if _write_buffer is None:
+        yield from write_changes([((model, pk), dict((f, ('set', v)) for f, v in values.items()))])
+        return
+    for field, value in values.items():
+        _write_buffer.add(model, pk, field, 'set', value)
+
+@asyncio.coroutine
+def buffer_increment(model, pk, field, n=1):
+    '''
+    Add n to a numeric column of one record through the write buffer; increments of the same record are summed.
+    '''
+    _check_buffered(model, field)
+    if _write_buffer is None:
+        yield from write_changes([((model, pk), {field: ('incr', n)})])
+        return
+    _write_buffer.add(model, pk, field, 'incr', n)
+
+#用无缓冲的服务端游标(SSDictCursor)分批读取结果,内存占用只和chunk_size有关
+#用法: async with Blog.iterate(where, args, chunk_size=500) as blogs:
+#          async for blog in blogs: ...
+#async with保证提前退出循环(break/return/异常)时归还连接;没有关闭就被丢弃的迭代器在__del__中关闭连接并归还
+class RowIterator(object):
+
+    def __init__(self, sql, args, chunk_size, factory, tuples=False):
+        self._sql = sql
+        self._tuples = tuples
+        self._args = args
+        self._chunk_size = chunk_size
+        self._factory = factory
+        self._lease = None
+        self._conn = None
+        self._cur = None
+        self._rows = iter(())
+        self._exhausted = False
+        self._done = False
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        r = next(self._rows, None)
+        if r is None:
+            if self._done:
+                raise StopAsyncIteration
+            try:
+                if self._cur is None:
+                    log(self._sql, self._args)
+                    tx = _transaction.get()
+                    if tx is not None:
+                        self._conn = tx.conn
+                    else:
+                        self._lease = yield from connection(replica_pool())
+                        self._conn = self._lease.conn
+                    self._cur = yield from self._conn.cursor(_driver.SSCursor if self._tuples else _driver.SSDictCursor)
+                    yield from _before_deadline(self._cur.execute(translate(self._sql), self._args or ()), self._conn)
+                rs = yield from _before_deadline(self._cur.fetchmany(self._chunk_size), self._conn)
+            except BaseException as e:
+                yield from self.close()
+                raise
+            if not rs:
+                self._exhausted = True
+                yield from self.close()
+                raise StopAsyncIteration
+            self._rows = iter(rs)
+            r = next(self._rows)
+        return self._factory(r)
+
+    @asyncio.coroutine
+    def __aenter__(self):
+        return self
 
+    @asyncio.coroutine
+    def __aexit__(self, exc_type, exc, tb):
+        yield from self.close()
+
+    def __del__(self):
+        # 兜底: 迭代器被丢弃时连接可能还借着,不能等待协程,直接关闭连接并归还,连接池会丢弃已关闭的连接
+        lease = getattr(self, '_lease', None)
+        if self._done or lease is None:
+            return
+        logging.warning('RowIterator abandoned before it was closed, use async with to release the connection')
+        self._done = True
+        self._lease = self._conn = self._cur = None
+        if lease.conn is not None:
+            lease.conn.close()
+        lease.release()
+
+    @asyncio.coroutine
+    def close(self):
+        if self._done:
+            return
+        self._done = True
+        self._rows = iter(())
+        lease, self._lease = self._lease, None
+        conn, self._conn = self._conn, None
+        cur, self._cur = self._cur, None
+        if conn is None:
+            return
+        if lease is None:
+            # 事务中的连接不能关闭,只能读完剩余的结果
+            if cur is not None:
+                yield from cur.close()
+            return
+        try:
+            if self._exhausted:
+                yield from cur.close()
+            else:
+                # 未读完的无缓冲结果集关闭游标时会被全部读出,直接关闭连接更快
+                conn.close()
+        finally:
+            lease.release()
+
+
+# 根据__mappings__和__indexes__生成建表语句,所有列都是not null
+def create_table_sql(model):
+    lines = ['    `%s` %s not null' % (k, model.__mappings__[k].column_type) for k in [model.__primary_key__] + model.__fields__]
+    for idx in model.__indexes__:
+        lines.append('    %skey `%s` (%s)' % ('unique ' if idx.unique else '', idx.name, ', '.join(map(lambda c: '`%s`' % c, idx.columns))))
+    lines.append('    primary key (`%s`)' % model.__primary_key__)
+    return 'create table `%s` (\n%s\n) engine=innodb default charset=utf8;' % (model.__table__, ',\n'.join(lines))
+
+def create_index_sql(model, idx):
+    return 'create %sindex `%s` on `%s` (%s);' % ('unique ' if idx.unique else '', idx.name, model.__table__, ', '.join(map(lambda c: '`%s`' % c, idx.columns)))
+
+# 给已有表补加模型中新增的列;默认值是常量时带上default,使已有行有合法的值(text列和可调用的默认值无法写进DDL)
+def add_column_sql(model, name):
+    field = model.__mappings__[name]
+    sql = 'alter table `%s` add column `%s` %s not null' % (model.__table__, name, field.column_type)
+    default = field.default
+    if isinstance(default, bool):
+        sql += ' default %d' % default
+    elif isinstance(default, (int, float)):
+        sql += ' default %r' % default
+    elif isinstance(default, str) and field.column_type.lower() != 'text':
+        sql += " default '%s'" % default.replace("'", "''")
+    return sql + ';'
+
+# 按模型建表(已存在的表跳过),主要用于在嵌入式SQLite后端上准备压测和测试数据
+@asyncio.coroutine
+def create_tables(*models):
+    for model in models:
+        if _driver is aiomysql:
+            statements = [create_table_sql(model).replace('create table', 'create table if not exists', 1)]
+        else:
+            statements = _driver.create_table_statements(model)
+        for sql in statements:
+            yield from execute(sql, ())
+
+# 对比模型声明的列、索引和数据库中的实际结构,返回需要执行的DDL;数据库中多出的列和索引只以注释列出,不自动删除
+@asyncio.coroutine
+def diff_schema(model):
+    if _driver is not aiomysql:
+        raise ValueError('diff_schema needs the MySQL backend')
+    cs = yield from select('select column_name from information_schema.columns where table_schema = database() and table_name = ? order by ordinal_position', [model.__table__])
+    if not cs:
+        return [create_table_sql(model)]
+    columns = [list(r.values())[0] for r in cs]
+    live_columns = set(c.lower() for c in columns)
+    mapped = [model.__primary_key__] + model.__fields__
+    sql = [add_column_sql(model, k) for k in mapped if k.lower() not in live_columns]
+    mapped_columns = set(k.lower() for k in mapped)
+    for c in columns:
+        if c.lower() not in mapped_columns:
+            sql.append('-- column `%s`.`%s` is not declared in the model' % (model.__table__, c))
+    rs = yield from select('select index_name, column_name, non_unique from information_schema.statistics where table_schema = database() and table_name = ? order by index_name, seq_in_index', [model.__table__])
+    live = collections.OrderedDict()
+    for r in rs:
+        r = dict((k.lower(), v) for k, v in r.items())
+        name = r['index_name']
+        if name not in live:
+            live[name] = ([], not int(r['non_unique']))
+        live[name][0].append(r['column_name'])
+    live_keys = set((tuple(cols), unique) for name, (cols, unique) in live.items() if name != 'PRIMARY')
+    declared = set((idx.columns, idx.unique) for idx in model.__indexes__)
+    for idx in model.__indexes__:
+        if (idx.columns, idx.unique) not in live_keys:
+            sql.append(create_index_sql(model, idx))
+    for name, (cols, unique) in live.items():
+        if name != 'PRIMARY' and (tuple(cols), unique) not in declared:
+            sql.append('-- index `%s` on `%s` (%s) is not declared in the model' % (name, model.__table__, ', '.join(cols)))
+    return sql
+
+
+# 按子表重新统计所有计数缓存列,用于修复直接改库等绕过orm的写入造成的计数偏差,返回每个计数更新的行数
+@asyncio.coroutine
+def repair_counters(*models):
+    statements = []
+    names = []
+    for model in models:
+        for i, (fk, target, counter) in enumerate(model.__counters__):
+            statements.append((model._recount_sql(i), None))
+            names.append('%s.%s' % (target.__table__, counter))
+    if not statements:
+        return {}
+    rows = yield from execute_batch(statements)
+    for model in models:
+        model._counters_changed()
+    return dict(zip(names, rows))
 
 #用于把查询字段计数替换成sql识别的?
 def create_args_string(num):  
@@ -77,38 +1310,253 @@ def create_args_string(num):
         lol.append('?')  
     return (','.join(lol)) 
 
+# 紧凑行: 列值保存在__slots__中,不为每行创建dict;支持属性访问、row['name']和_asdict()
+class Row(object):
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return self.__slots__
+
+    def _asdict(self):
+        return dict((k, getattr(self, k, None)) for k in self.__slots__)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % (k, getattr(self, k, None)) for k in self.__slots__))
+
+#生成按列顺序接收tuple各项的Row子类,__init__按位置参数赋值
+def create_row_class(name, columns):
+    params = ['_%s' % i for i in range(len(columns))]
+    code = 'def __init__(self, %s):\n%s\n' % (', '.join(params), '\n'.join('    self.%s = %s' % (c, p) for c, p in zip(columns, params)))
+    ns = dict()
+    exec(code, ns)
+    return type('%sRow' % name, (Row,), dict(__slots__=tuple(columns), __init__=ns['__init__']))
+
+#生成按__insert__列顺序取参数的函数,值为None时和getValueOrDefault一样填入默认值并写回实例
+def create_insert_args(mappings, columns):
+    ns = dict()
+    lines = ['def __insert_args__(self):', '    get = self.get']
+    for i, c in enumerate(columns):
+        lines.append('    v%s = get(%r)' % (i, c))
+        default = mappings[c].default
+        if default is not None:
+            ns['_d%s' % i] = default
+            lines.append('    if v%s is None:' % i)
+            lines.append('        v%s = self[%r] = %s' % (i, c, '_d%s()' % i if callable(default) else '_d%s' % i))
+    lines.append('    return [%s]' % ', '.join('v%s' % i for i in range(len(columns))))
+    exec('\n'.join(lines), ns)
+    return ns['__insert_args__']
+
+#生成按__update__列顺序取参数的函数
+def create_update_args(columns):
+    ns = dict()
+    exec('def __update_args__(self):\n    get = self.get\n    return [%s]\n' % ', '.join('get(%r)' % c for c in columns), ns)
+    return ns['__update_args__']
+
+#生成从查询结果(dict)直接创建实例的函数,不经过__init__的关键字参数展开;创建的实例开始记录修改过的列
+def create_from_row(cls):
+    def __from_row__(row, _new=dict.__new__, _update=dict.update):
+        obj = _new(cls)
+        _update(obj, row)
+        obj.__dict__['_dirty'] = set()
+        return obj
+    return __from_row__
+
+#生成查询指定列的SELECT,主键总是排在第一列
+def create_select(table_name, primary_key, fields):
+    return 'select %s from `%s` ' % (', '.join(map(lambda f: '`%s`' % f, [primary_key] + list(fields))), table_name)
+
+#生成INSERT ... ON DUPLICATE KEY UPDATE的更新部分,主键冲突时用新值覆盖其他字段
+def create_upsert_clause(fields, primary_key):
+    cols = fields or [primary_key]
+    return ' on duplicate key update %s' % ', '.join(map(lambda f: '`%s`=values(`%s`)' % (f, f), cols))
+
 
 class Field(object):
-    def __init__(self,name,column_type,primary_key,default):
+    def __init__(self,name,column_type,primary_key,default,deferred=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.deferred = deferred # 延迟加载的列默认不查询,需要时用undefer/columns或load_deferred()读取
         
     def __str__(self):
         return '<%s, %s, %s>' % (self.__class__.__name__,self.name,self.column_type)
 
 class StringField(Field):
-    def __init__(self,name=None,primary_key=False,default=None,ddl='varchar(100)'):
-        super().__init__(name, ddl, primary_key, default)
+    def __init__(self,name=None,primary_key=False,default=None,ddl='varchar(100)',deferred=False):
+        super().__init__(name, ddl, primary_key, default, deferred)
 
 # 布尔类型不可以作为主键  
 class BooleanField(Field):  
-    def __init__(self, name=None,primary_key=False, default=False,ddl='Boolean'):  
-        super().__init__(name,ddl,primary_key, default) 
+    def __init__(self, name=None,primary_key=False, default=False,ddl='Boolean',deferred=False):  
+        super().__init__(name,ddl,primary_key, default, deferred) 
 
 class IntegerField(Field):  
-    def __init__(self, name=None, primary_key=False, default=0,ddl='int'):  
-        super().__init__(name, ddl, primary_key, default) 
+    def __init__(self, name=None, primary_key=False, default=0,ddl='int',deferred=False):  
+        super().__init__(name, ddl, primary_key, default, deferred) 
+
+# 计数列: 由子表的__counters__声明或buffer_increment()维护,save/update/upsert不会用实例上的值覆盖它
+class CounterField(IntegerField):
+    def __init__(self, name=None, default=0, ddl='int'):
+        super().__init__(name, False, default, ddl)
 
 class FloatField(Field):
-    def __init__(self, name=None, primary_key=False, default=0.0,ddl='float'):  
-        super().__init__(name, ddl, primary_key, default) 
+    def __init__(self, name=None, primary_key=False, default=0.0,ddl='float',deferred=False):  
+        super().__init__(name, ddl, primary_key, default, deferred) 
 
 class TextField(Field):
-    def __init__(self, name=None, primary_key=False, default=None,ddl='text'):  
-        super().__init__(name, ddl, primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=None,ddl='text',deferred=False):  
+        super().__init__(name, ddl, primary_key, default, deferred)
+
+
+# 索引声明: __indexes__ = [Index('email', unique=True), Index('user_id', 'created_at')]
+class Index(object):
+    def __init__(self, *columns, name=None, unique=False):
+        if not columns:
+            raise ValueError('Index needs at least one column')
+        self.columns = tuple(columns)
+        self.name = name or 'idx_%s' % '_'.join(columns)
+        self.unique = unique
 
+    def __str__(self):
+        return '<%s, %s, %s>' % (self.__class__.__name__, self.name, ', '.join(self.columns))
+
+
+# 关键字过滤查询: Model.filter(email=..., created_at__gt=...).order_by('-created_at').limit(n)
+# 同一形状(列、操作符、in的参数个数)的where只编译一次,缓存在模型的语句缓存中,列名在编译时校验
+_LOOKUPS = {
+    'exact': '=',
+    'ne': '<>',
+    'gt': '>',
+    'gte': '>=',
+    'lt': '<',
+    'lte': '<=',
+    'like': 'like',
+    'in': 'in'
+}
+
+class Query(object):
+
+    def __init__(self, model):
+        self.model = model
+        self._where = None
+        self._args = []
+        self._order = None
+        self._limit = None
+
+    def _clone(self):
+        q = Query(self.model)
+        q._where, q._args, q._order, q._limit = self._where, list(self._args), self._order, self._limit
+        return q
+
+    def filter(self, **kw):
+        model = self.model
+        shape = []
+        args = []
+        for key in sorted(kw):
+            value = kw[key]
+            column, _, op = key.partition('__')
+            op = op or 'exact'
+            if op == 'in':
+                value = list(value)
+                shape.append((column, op, len(value)))
+                args.extend(value)
+            elif value is None and op in ('exact', 'ne'):
+                shape.append((column, op, None))
+            else:
+                shape.append((column, op, 1))
+                args.append(value)
+        shape = tuple(shape)
+        def build():
+            cond = []
+            for column, op, n in shape:
+                if column not in model.__mappings__:
+                    raise ValueError('Invalid column : %s ' % column)
+                if op not in _LOOKUPS:
+                    raise ValueError('Invalid lookup : %s__%s ' % (column, op))
+                if n is None:
+                    cond.append('`%s` is %snull' % (column, 'not ' if op == 'ne' else ''))
+                elif op == 'in':
+                    cond.append('`%s` in (%s)' % (column, create_args_string(n)) if n else '1 = 0')
+                else:
+                    cond.append('`%s` %s ?' % (column, _LOOKUPS[op]))
+            return ' and '.join(cond)
+        where = model.statement(('filter', shape), build)
+        q = self._clone()
+        if where:
+            q._where = '%s and %s' % (q._where, where) if q._where else where
+            q._args.extend(args)
+        return q
+
+    def order_by(self, *columns):
+        '''
+        Sort by the given columns, a leading '-' means descending: order_by('-created_at').
+        '''
+        model = self.model
+        def build():
+            order = []
+            for c in columns:
+                desc = c.startswith('-')
+                c = c.lstrip('-')
+                if c not in model.__mappings__:
+                    raise ValueError('Invalid column : %s ' % c)
+                order.append('`%s` %s' % (c, 'desc' if desc else 'asc'))
+            return ', '.join(order)
+        q = self._clone()
+        q._order = model.statement(('order', columns), build) or None
+        return q
+
+    def limit(self, *limit):
+        '''
+        limit(n) or limit(offset, n).
+        '''
+        q = self._clone()
+        q._limit = limit[0] if len(limit) == 1 else limit
+        return q
+
+    def _kw(self, **kw):
+        if self._order is not None:
+            kw['orderBy'] = self._order
+        if self._limit is not None:
+            kw.setdefault('limit', self._limit)
+        return kw
+
+    @asyncio.coroutine
+    def all(self, **kw):
+        '''
+        Return the matching records; kw is passed on to findAll (columns, undefer, compact).
+        '''
+        return (yield from self.model.findAll(self._where, list(self._args), **self._kw(**kw)))
+
+    @asyncio.coroutine
+    def first(self, **kw):
+        kw['limit'] = 1
+        rs = yield from self.all(**kw)
+        return rs[0] if rs else None
+
+    @asyncio.coroutine
+    def count(self):
+        return (yield from self.model.findNumber('count(`%s`)' % self.model.__primary_key__, self._where, list(self._args)))
+
+    def iterate(self, chunk_size=500, **kw):
+        return self.model.iterate(self._where, list(self._args), chunk_size, **self._kw(**kw))
+
+    # 查询对象可以直接等待: users = yield from User.filter(email=email) 或 users = await User.filter(email=email)
+    def __iter__(self):
+        return self.all()
+
+    # __await__必须返回迭代器而不是协程,用普通生成器包一层
+    def __await__(self):
+        return (yield from self.all())
 
 #model元类
 class ModelMetaclass(type):
@@ -130,6 +1578,8 @@ class ModelMetaclass(type):
                     logging.info('found primary key %s'%k)  
                     if primary_key:  
                         raise RuntimeError('Duplicated key for field') #主键不可重复
+                    if v.deferred:
+                        raise RuntimeError('Primary key can not be deferred')
                     primary_key = k
                 else:
                     fields.append(k)
@@ -140,17 +1590,52 @@ class ModelMetaclass(type):
         for k in mappings.keys():
             attrs.pop(k) #从类属性中删除Field,防止实例属性遮住类的同名属性
         
+        indexes = []
+        for idx in attrs.get('__indexes__', None) or ():
+            if isinstance(idx, str):
+                idx = Index(idx)
+            elif isinstance(idx, (tuple, list)):
+                idx = Index(*idx)
+            for c in idx.columns:
+                if c not in mappings:
+                    raise RuntimeError('Index column not found: %s' % c)
+            indexes.append(idx)
+        
+        # 计数缓存: __counters__ = [('blog_id', Blog, 'comment_count')]表示本表每行计入Blog中主键为blog_id的那一行的comment_count
+        counters = []
+        for fk, target, counter in attrs.get('__counters__', None) or ():
+            if fk not in mappings:
+                raise RuntimeError('Counter column not found: %s' % fk)
+            if not isinstance(target.__mappings__.get(counter), CounterField):
+                raise RuntimeError('Counter field not found: %s.%s' % (target.__name__, counter))
+            counters.append((fk, target, counter))
+        
         other_fields = list(map(lambda f:'`%s`' %f, fields)) # 将除主键外的其他属性变成`id`, `name`这种形式
         # 保存属性和列的映射关系
         attrs['__mappings__'] = mappings
         attrs['__table__'] = table_name
         attrs['__primary_key__'] = primary_key
         attrs['__fields__']=fields 
-        attrs['__select__']='select `%s`, %s from `%s` '%(primary_key,', '.join(other_fields), table_name)
+        attrs['__indexes__'] = indexes
+        attrs['__deferred__'] = [f for f in fields if mappings[f].deferred]
+        attrs['__counters__'] = counters
+        # update和upsert写回的列,不包括计数缓存列
+        updatable = [f for f in fields if not isinstance(mappings[f], CounterField)]
+        attrs['__updatable__'] = updatable
+        # __select__只包含非延迟加载的列
+        attrs['__select__'] = create_select(table_name, primary_key, [f for f in fields if not mappings[f].deferred])
         attrs['__insert__'] = 'insert into  `%s` (%s, `%s`) values (%s) ' %(table_name, ', '.join(other_fields), primary_key, create_args_string(len(other_fields)+1))
-        attrs['__update__']='update `%s` set %s where `%s` = ?' % (table_name, ', '.join(map(lambda f:'`%s`=?' % (mappings.get(f).name or f), fields)), primary_key)  
+        attrs['__upsert__'] = attrs['__insert__'].rstrip() + create_upsert_clause(updatable, primary_key)
+        attrs['__update__']='update `%s` set %s where `%s` = ?' % (table_name, ', '.join(map(lambda f:'`%s`=?' % (mappings.get(f).name or f), updatable)), primary_key)  
         attrs['__delete__']='delete from `%s` where `%s`=?' %(table_name, primary_key)  
-        return type.__new__(cls, name, bases, attrs)
+        attrs['__statements__'] = dict() # 按查询形状缓存拼接好的SQL
+        attrs['__row__'] = create_row_class(name, [primary_key] + [f for f in fields if not mappings[f].deferred]) # compact=True时使用的紧凑行类
+        # 每个模型专用的参数提取函数,save/update时不再逐列getattr和查__mappings__
+        attrs['__insert_args__'] = create_insert_args(mappings, fields + [primary_key])
+        attrs['__update_args__'] = create_update_args(updatable + [primary_key])
+        klass = type.__new__(cls, name, bases, attrs)
+        klass.__from_row__ = staticmethod(create_from_row(klass))
+        return klass
     
 
 #基本定义的映射的基类Model
@@ -162,6 +1647,8 @@ class Model(dict,metaclass=ModelMetaclass):
         try:
             return self[key]
         except KeyError:
+            if key in getattr(type(self), '__mappings__', ()):
+                raise AttributeError("column not loaded: %s, query it with undefer/columns or call load_deferred()" % key)
             raise AttributeError("object have no attribution: %s"% key) 
     
     def __setattr__(self,key,value):
@@ -170,6 +1657,23 @@ class Model(dict,metaclass=ModelMetaclass):
         except KeyError:
             raise AttributeError("object have no attribution: %s"% key) 
     
+    # 从数据库加载或保存过的实例记录之后改过值的列(_dirty),update()只写回这些列;新建的实例_dirty为None
+    def __setitem__(self, key, value):
+        dirty = self.__dict__.get('_dirty')
+        if dirty is not None and (key not in self or dict.__getitem__(self, key) != value):
+            dirty.add(key)
+        dict.__setitem__(self, key, value)
+    
+    def dirty_fields(self):
+        '''
+        Return the columns changed since the instance was loaded or saved, or None if it was never loaded.
+        '''
+        dirty = self.__dict__.get('_dirty')
+        return None if dirty is None else set(dirty)
+    
+    def _mark_clean(self):
+        self.__dict__['_dirty'] = set()
+    
     def getValue(self,key):
         return getattr(self,key,None)
     
@@ -184,80 +1688,388 @@ class Model(dict,metaclass=ModelMetaclass):
    
         return value
     
+    @classmethod
+    def statement(cls, key, build):
+        '''
+        Return the SQL cached under key for this model, calling build() to assemble it on a miss.
+        '''
+        sql = cls.__statements__.get(key)
+        if sql is None:
+            if len(cls.__statements__) >= _MAX_STATEMENTS:
+                cls.__statements__.clear()
+            sql = cls.__statements__[key] = build()
+        return sql
     
     @classmethod
     @asyncio.coroutine
     #通过主键查找
-    def find(cls, pk):
-        rs = yield from select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
-        if len(rs) == 0:
-            return None
-        return cls(**rs[0])    
+    def find(cls, pk, columns=None, undefer=None):
+        if columns is not None or undefer:
+            # 指定了列的查询结果不完整,不经过identity map和批量加载
+            projection = cls._projection(columns, undefer)
+            sql = cls.statement(('find', projection), lambda: '%swhere `%s`=?' % (create_select(cls.__table__, cls.__primary_key__, projection), cls.__primary_key__))
+            rs = yield from cached_select(cls.__table__, sql, [pk], 1)
+            return cls.__from_row__(rs[0]) if rs else None
+        im = _identity_map.get()
+        if im is not None:
+            obj = im.get((cls, pk))
+            if obj is not None:
+                return obj
+        if _batching is not None and _transaction.get() is None:
+            # 批量查询不受本请求截止时间的限制,等待结果时仍按本请求的截止时间超时
+            obj = yield from _before_deadline(loader(cls).load(pk), stage='query')
+            if obj is None:
+                return None
+        else:
+            sql = cls.statement(('find',), lambda: '%s where `%s`=?' % (cls.__select__, cls.__primary_key__))
+            rs = yield from cached_select(cls.__table__, sql, [pk], 1)
+            if len(rs) == 0:
+                return None
+            obj = cls.__from_row__(rs[0])
+        if im is not None:
+            im[(cls, pk)] = obj
+        return obj
     
+    @classmethod
+    def filter(cls, **kw):
+        '''
+        Start a keyword query: Model.filter(email=email, created_at__gt=t).order_by('-created_at').limit(10).
+        '''
+        return Query(cls).filter(**kw)
+
     @classmethod  
     @asyncio.coroutine
     def findAll(cls, where=None, args=None, **kw):  
-        sql = [cls.__select__]  
-        if where:  
-            sql.append('where')  
-            sql.append(where)  
+        sql, args, projection = cls._select_sql(where, args, kw)  
+        if kw.get('compact', False):
+            # 紧凑模式: 用tuple游标读取,结果是只读形状的Row对象
+            row = cls._row_class(projection)
+            rs = yield from cached_select(cls.__table__, sql, args, tuples=True)
+            return [row(*r) for r in rs]
+        rs = yield from cached_select(cls.__table__, sql, args) #返回的rs是一个元素是tuple的list  
+        return list(map(cls.__from_row__, rs))  # 每一条记录对应一个cls类的实例
+
+    @classmethod
+    def iterate(cls, where=None, args=None, chunk_size=500, **kw):
+        '''
+        Return an async iterator over the matching records, read in chunks through an unbuffered server-side cursor.
+        Use it with async with so the connection is released when the loop exits early.
+        '''
+        if not isinstance(chunk_size, int) or chunk_size < 1:
+            raise ValueError('Invalid chunk_size value : %s ' % str(chunk_size))
+        sql, args, projection = cls._select_sql(where, args, kw)
+        if kw.get('compact', False):
+            row = cls._row_class(projection)
+            return RowIterator(sql, args, chunk_size, lambda r: row(*r), True)
+        return RowIterator(sql, args, chunk_size, cls.__from_row__)
+
+    @classmethod
+    def _select_sql(cls, where, args, kw):
         if args is None:  
             args = []  
-   
         orderBy = kw.get('orderBy', None)  
-        if orderBy:  
-            sql.append('order by')  
-            sql.append(orderBy)  
-          
+        projection = None
+        if kw.get('columns', None) is not None or kw.get('undefer', None):
+            projection = cls._projection(kw.get('columns', None), kw.get('undefer', None))
+        # 键集(seek)分页: after=(排序列的值, 主键)表示从这条记录之后开始取,第一页传after=None
+        seek = None
+        if 'after' in kw:
+            seek = cls._seek_order(orderBy or 'created_at desc')
+            orderBy = '`%s` %s, `%s` %s' % (seek[0], seek[1], cls.__primary_key__, seek[1])
+            after = kw['after']
+            if after is not None:
+                if not isinstance(after, (tuple, list)) or len(after) != 2:
+                    raise ValueError('Invalid after value : %s ' % str(after))
+                args.extend((after[0], after[0], after[1]))
+            else:
+                seek = None
         limit = kw.get('limit', None)  
-        if limit is not None:  
-            sql.append('limit')  
-            if isinstance(limit, int):  
-                sql.append('?')  
-                args.append(limit)  
-            elif isinstance(limit, tuple) and len(limit) ==2:  
-                sql.append('?,?')  
-                args.extend(limit)  
-            else:  
-                raise ValueError('Invalid limit value : %s ' % str(limit))  
+        if limit is None:  
+            shape = None  
+        elif isinstance(limit, int):  
+            shape = 1  
+            args.append(limit)  
+        elif isinstance(limit, tuple) and len(limit) ==2:  
+            shape = 2  
+            args.extend(limit)  
+        else:  
+            raise ValueError('Invalid limit value : %s ' % str(limit))  
+   
+        def build():  
+            sql = [cls.__select__ if projection is None else create_select(cls.__table__, cls.__primary_key__, projection)]  
+            cond = where
+            if seek:
+                op = '<' if seek[1] == 'desc' else '>'
+                cond = '(`%s` %s ? or (`%s` = ? and `%s` %s ?))' % (seek[0], op, seek[0], cls.__primary_key__, op)
+                if where:
+                    cond = '(%s) and %s' % (where, cond)
+            if cond:  
+                sql.append('where')  
+                sql.append(cond)  
+            if orderBy:  
+                sql.append('order by')  
+                sql.append(orderBy)  
+            if shape:  
+                sql.append('limit')  
+                sql.append(create_args_string(shape))  
+            return ' '.join(sql)  
    
-        rs = yield from select(' '.join(sql),args) #返回的rs是一个元素是tuple的list  
-        return [cls(**r) for r in rs]  # **r 是关键字参数，构成了一个cls类的列表，就是每一条记录对应的类实例    
+        return cls.statement(('findAll', where, orderBy, shape, seek, projection), build), args, projection
+
+    @classmethod
+    def _row_class(cls, projection):
+        if projection is None:
+            return cls.__row__
+        return cls.statement(('row', projection), lambda: create_row_class(cls.__name__, (cls.__primary_key__,) + projection))
+
+    @classmethod
+    def _projection(cls, columns, undefer):
+        # columns: 只查询这些列; undefer: 在默认列之外再查询这些延迟加载的列; 主键总会被查询
+        columns = tuple(columns) if columns is not None else None
+        undefer = tuple(undefer) if undefer else ()
+        def build():
+            if columns is None:
+                wanted = set(f for f in cls.__fields__ if not cls.__mappings__[f].deferred)
+            else:
+                wanted = set(columns)
+            wanted.update(undefer)
+            for c in wanted:
+                if c not in cls.__mappings__:
+                    raise ValueError('Invalid column : %s ' % c)
+            return tuple(f for f in cls.__fields__ if f in wanted)
+        return cls.statement(('projection', columns, undefer), build)
+
+    @classmethod
+    def _seek_order(cls, orderBy):
+        # seek分页只支持按单个列排序,主键作为第二排序列保证顺序稳定
+        parts = orderBy.replace('`', '').split()
+        if len(parts) == 1:
+            parts.append('asc')
+        if len(parts) != 2 or parts[0] not in cls.__mappings__ or parts[1].lower() not in ('asc', 'desc'):
+            raise ValueError('Invalid orderBy value for seek : %s ' % orderBy)
+        return (parts[0], parts[1].lower())
 
     @classmethod  
     @asyncio.coroutine  
-    def findNumber(cls, selectField, where=None, args=None):  
-        '''''find number by select and where.'''  
-        sql = ['select %s __num__ from `%s`' %(selectField, cls.__table__)]  
-        if where:  
-            sql.append('where')  
-            sql.append(where)  
-        rs = yield from select(' '.join(sql), args, 1)  
+    def findNumber(cls, selectField, where=None, args=None, cached=False, approximate=False):  
+        '''''find number by select and where.
+        cached=True returns an in-process row counter kept up to date by inserts and deletes,
+        approximate=True returns the row estimate from the table statistics; both need a count without where.'''  
+        if cached or approximate:
+            if where or not selectField.replace(' ', '').lower().startswith('count('):
+                raise ValueError('cached and approximate findNumber only support count without where')
+        if approximate and _driver is not aiomysql:
+            # SQLite没有information_schema,退回精确计数
+            approximate = False
+        if approximate:
+            sql = 'select table_rows __num__ from information_schema.tables where table_schema = database() and table_name = ?'
+            rs = yield from cached_select(cls.__table__, sql, [cls.__table__], 1)
+            if len(rs) == 0 or rs[0]['__num__'] is None:
+                return None
+            return int(rs[0]['__num__'])
+        if cached:
+            c = _row_counts.get(cls.__table__)
+            if c is not None and c[1] > time.monotonic():
+                return c[0]
+        def build():  
+            sql = ['select %s __num__ from `%s`' %(selectField, cls.__table__)]  
+            if where:  
+                sql.append('where')  
+                sql.append(where)  
+            return ' '.join(sql)  
+        sql = cls.statement(('findNumber', selectField, where), build)  
+        rs = yield from cached_select(cls.__table__, sql, args, 1)  
         if len(rs) == 0:  
             return None  
+        if cached and _transaction.get() is None:
+            _row_counts[cls.__table__] = [rs[0]['__num__'], time.monotonic() + _COUNT_TTL]
         return rs[0]['__num__']
     
     @asyncio.coroutine
     def save(self):
-        args = list(map(self.getValueOrDefault, self.__fields__))
-        #print('save:%s' % args)
-        args.append(self.getValueOrDefault(self.__primary_key__))
-        rows = yield from execute(self.__insert__, args)
+        args = self.__insert_args__()
+        forget(self.__class__, args[-1])
+        rows = yield from self._write_counted(self.__insert__, args, args[-1], False)
+        self._mark_clean()
+        invalidate(self.__table__)
+        adjust_count(self.__table__, rows)
         if rows != 1:
             logging.warn('failed to insert record: affected rows: %s' % rows)
 
+    @classmethod
+    @asyncio.coroutine
+    def save_many(cls, instances, batch_size=100):
+        '''
+        Insert instances with multi-row INSERT statements in one transaction, return the affected rows of each batch.
+        '''
+        instances = list(instances)
+        rows = yield from cls._write_many(instances, batch_size, False)
+        for i, r in enumerate(rows):
+            if r != min(batch_size, len(instances) - i * batch_size):
+                logging.warning('failed to insert batch %s: affected rows: %s' % (i, r))
+        return rows
+
+    @asyncio.coroutine
+    def upsert(self):
+        '''
+        Insert the record or update it if the primary key exists, return the affected rows (1 inserted, 2 updated, 0 unchanged).
+        '''
+        args = self.__insert_args__()
+        forget(self.__class__, args[-1])
+        rows = yield from self._write_counted(self.__upsert__, args, args[-1], True)
+        self._mark_clean()
+        invalidate(self.__table__)
+        adjust_count(self.__table__, 1 if rows == 1 else 0)
+        if rows not in (0, 1, 2):
+            logging.warning('failed to upsert record: affected rows: %s' % rows)
+        return rows
+
+    @classmethod
+    @asyncio.coroutine
+    def upsert_many(cls, instances, batch_size=100):
+        '''
+        Upsert instances with multi-row statements in one transaction, return the affected rows of each batch.
+        '''
+        return (yield from cls._write_many(instances, batch_size, True))
+
+    @classmethod
+    @asyncio.coroutine
+    def _write_many(cls, instances, batch_size, upsert):
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise ValueError('Invalid batch_size value : %s ' % str(batch_size))
+        if not isinstance(instances, list):
+            instances = list(instances)
+        def build(n):
+            # 多行INSERT沿用__insert__的列顺序,只在后面追加每行的占位符
+            sql = cls.__insert__.rstrip() + (', (%s)' % create_args_string(len(cls.__fields__) + 1)) * (n - 1)
+            if upsert:
+                sql = sql + create_upsert_clause(cls.__updatable__, cls.__primary_key__)
+            return sql
+        statements = []
+        counted = []
+        for i in range(0, len(instances), batch_size):
+            batch = instances[i:i + batch_size]
+            args = []
+            for inst in batch:
+                args.extend(inst.__insert_args__())
+                forget(cls, args[-1])
+            n = len(batch)
+            pks = args[len(cls.__fields__)::len(cls.__fields__) + 1]
+            if upsert:
+                statements.extend(cls._batch_counters(pks, '-'))
+            statements.append((cls.statement(('upsert_many' if upsert else 'save_many', n), lambda: build(n)), args))
+            counted.append(len(statements) - 1)
+            statements.extend(cls._batch_counters(pks, '+'))
+        if not statements:
+            return []
+        rows = yield from execute_batch(statements)
+        rows = [rows[i] for i in counted]
+        for inst in instances:
+            inst._mark_clean()
+        cls._counters_changed()
+        invalidate(cls.__table__)
+        # upsert影响的行数无法区分插入和更新
+        adjust_count(cls.__table__, None if upsert else sum(rows))
+        return rows
+
     @asyncio.coroutine
     def delete(self):  
         args = [self.getValue(self.__primary_key__)]  
-        rows = yield from execute(self.__delete__, args)  
+        forget(self.__class__, args[0])
+        rows = yield from self._write_counted(self.__delete__, args, args[0], True, False)
+        invalidate(self.__table__)
+        adjust_count(self.__table__, -rows)
         if rows != 1:  
             logging.warning('failed to delete by primary key: affected rows: %s' %rows)
     
+    @asyncio.coroutine
+    def _write_counted(self, sql, args, pk, before, after=True):
+        # 没有计数缓存时直接执行;否则和父表的计数调整放在同一个事务中执行:
+        # before为True时先给这一行当前所属的父记录减一,after为True时写入后再给这一行所属的父记录加一
+        cls = self.__class__
+        if not cls.__counters__ or not (before or after):
+            return (yield from execute(sql, args))
+        statements = []
+        if before:
+            statements.extend((cls._counter_sql(i, '-'), [pk]) for i in range(len(cls.__counters__)))
+        statements.append((sql, args))
+        if after:
+            statements.extend((cls._counter_sql(i, '+'), [pk]) for i in range(len(cls.__counters__)))
+        rows = yield from execute_batch(statements)
+        cls._counters_changed()
+        return rows[len(cls.__counters__) if before else 0]
+
+    @classmethod
+    def _counter_sql(cls, i, op):
+        fk, target, counter = cls.__counters__[i]
+        return cls.statement(('counter', i, op), lambda: 'update `%s` set `%s` = `%s` %s 1 where `%s` = (select `%s` from `%s` where `%s` = ?)' % (target.__table__, counter, counter, op, target.__primary_key__, fk, cls.__table__, cls.__primary_key__))
+
+    @classmethod
+    def _batch_counters(cls, pks, op):
+        # 批量写入时每个计数一条语句: 按这一批记录当前所属的父记录分组加减
+        n = len(pks)
+        statements = []
+        for i, (fk, target, counter) in enumerate(cls.__counters__):
+            sql = cls.statement(('counter_many', i, op, n), lambda: 'update `%s` set `%s` = `%s` %s (select count(*) from `%s` where `%s`.`%s` = `%s`.`%s` and `%s`.`%s` in (%s)) where `%s` in (select `%s` from `%s` where `%s` in (%s))' % (
+                target.__table__, counter, counter, op, cls.__table__, cls.__table__, fk, target.__table__, target.__primary_key__, cls.__table__, cls.__primary_key__, create_args_string(n),
+                target.__primary_key__, fk, cls.__table__, cls.__primary_key__, create_args_string(n)))
+            statements.append((sql, pks + pks))
+        return statements
+
+    @classmethod
+    def _recount_sql(cls, i):
+        fk, target, counter = cls.__counters__[i]
+        return 'update `%s` set `%s` = (select count(*) from `%s` where `%s`.`%s` = `%s`.`%s`)' % (target.__table__, counter, cls.__table__, cls.__table__, fk, target.__table__, target.__primary_key__)
+
+    @classmethod
+    def _counters_changed(cls):
+        # 父表的计数变了,已缓存的查询结果和identity map中的父记录都不再可信
+        for fk, target, counter in cls.__counters__:
+            invalidate(target.__table__)
+            im = _identity_map.get()
+            if im is not None:
+                for key in [k for k in im if k[0] is target]:
+                    del im[key]
+
+    @asyncio.coroutine
+    def load_deferred(self, *names):
+        '''
+        Load the given columns into this instance, by default every deferred column not loaded yet.
+        '''
+        cls = self.__class__
+        if not names:
+            names = [f for f in cls.__deferred__ if f not in self]
+            if not names:
+                return self
+        projection = cls._projection(names, None)
+        sql = cls.statement(('find', projection), lambda: '%swhere `%s`=?' % (create_select(cls.__table__, cls.__primary_key__, projection), cls.__primary_key__))
+        rs = yield from cached_select(cls.__table__, sql, [self.getValue(cls.__primary_key__)], 1)
+        if rs:
+            dict.update(self, rs[0])
+        return self
+
     @asyncio.coroutine       
     def update(self): #修改数据库中已经存入的数据  
-        args = list(map(self.getValue, self.__fields__))   
-        args.append(self.getValue(self.__primary_key__))  
-        rows = yield from execute(self.__update__, args)  
+        # 没有加载的列(延迟加载或被投影掉的列)不写回,避免用空值覆盖数据库中的数据;
+        # 加载过的实例只写回修改过的列,没有修改时不访问数据库
+        dirty = self.__dict__.get('_dirty')
+        fields = [f for f in self.__updatable__ if f in self and (dirty is None or f in dirty)]
+        if len(fields) == len(self.__updatable__):
+            sql = self.__update__
+            args = self.__update_args__()
+        elif not fields:
+            return
+        else:
+            cls = self.__class__
+            sql = cls.statement(('update', tuple(fields)), lambda: 'update `%s` set %s where `%s` = ?' % (cls.__table__, ', '.join(map(lambda f: '`%s`=?' % (cls.__mappings__.get(f).name or f), fields)), cls.__primary_key__))
+            args = list(map(self.get, fields))
+            args.append(self.get(cls.__primary_key__))
+        forget(self.__class__, args[-1])
+        # 修改了计数列对应的外键时,原来和新的父记录的计数都要调整
+        moved = any(fk in fields for fk, target, counter in self.__counters__)
+        rows = yield from self._write_counted(sql, args, args[-1], moved, moved)
+        self._mark_clean()
+        invalidate(self.__table__)
         if rows != 1:  
             logging.warning('failed to update record: affected rows: %s'%rows)
             
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# repair_counters.py
+# 根据子表重新统计models.py中声明的所有计数缓存列(例如blogs.comment_count)
+# 执行migrate.sql添加计数列后运行一次,为已有数据回填计数;之后可随时运行以修复偏差
+# 用法: python3 repair_counters.py
+
+import asyncio
+
+import orm
+from models import User, Blog, Comment
+from config import configs
+
+MODELS = [User, Blog, Comment]
+
+@asyncio.coroutine
+def repair(loop):
+    db = configs.db
+    if db.backend == 'sqlite':
+        yield from orm.create_pool(loop=loop, backend='sqlite', db=db.database, ping_interval=0)
+    else:
+        yield from orm.create_pool(loop=loop, host=db.host, port=db.port, user=db.user, password=db.password, db=db.database, ping_interval=0)
+    try:
+        rows = yield from orm.repair_counters(*MODELS)
+        for name, n in sorted(rows.items()):
+            print('%s: %s row(s) updated' % (name, n))
+    finally:
+        yield from orm.destroy_pool()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(repair(loop))
+    loop.close()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# schema_diff.py
+# 对比models.py中声明的表结构、索引和数据库中的实际结构,打印需要执行的DDL
+# 用法: python3 schema_diff.py          打印缺少的建表、加列和建索引语句
+#       python3 schema_diff.py --ddl    只打印根据模型生成的完整建表语句,不连接数据库
+
+import sys, asyncio
+
+import orm
+from models import User, Blog, Comment
+from config import configs
+
+MODELS = [User, Blog, Comment]
+
+@asyncio.coroutine
+def diff(loop):
+    db = configs.db
+    yield from orm.create_pool(loop=loop, host=db.host, port=db.port, user=db.user, password=db.password, db=db.database)
+    try:
+        for model in MODELS:
+            sql = yield from orm.diff_schema(model)
+            print('-- %s: %s' % (model.__table__, 'up to date' if not sql else '%s change(s)' % len(sql)))
+            for s in sql:
+                print(s)
+    finally:
+        yield from orm.destroy_pool()
+
+if __name__ == '__main__':
+    if '--ddl' in sys.argv[1:]:
+        for model in MODELS:
+            print(orm.create_table_sql(model))
+            print()
+        sys.exit(0)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(diff(loop))
+    loop.close()
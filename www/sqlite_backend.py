@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# sqlite_backend.py
+# 嵌入式SQLite后端,提供orm用到的aiomysql接口子集(create_pool、连接池、连接和游标),
+# 用于在没有MySQL服务器时对整个应用做压测和测试:
+#     yield from orm.create_pool(loop=loop, backend='sqlite', db=':memory:')
+# 数据库调用在线程池中执行,不阻塞事件循环
+# db为':memory:'或其他不带路径的名字时使用共享缓存的内存数据库,否则为文件数据库(WAL模式)
+# 内存数据库中并发的写事务会因为表锁失败,需要并发写入的压测请使用文件数据库
+
+import asyncio, logging, re, sqlite3, functools
+
+# 与aiomysql同名的游标类型,orm按名字选择返回dict还是tuple
+class Cursor(object):
+    dict_rows = False
+
+class DictCursor(Cursor):
+    dict_rows = True
+
+class SSCursor(Cursor):
+    dict_rows = False
+
+class SSDictCursor(Cursor):
+    dict_rows = True
+
+_RE_UPSERT = re.compile(r'^\s*insert\s+into\s+`?(\w+)`?\s*\((.*?)\)\s*values(.*)\son duplicate key update\s(.*)$', re.I | re.S)
+_RE_VALUES = re.compile(r'values\(`?(\w+)`?\)', re.I)
+
+# 改写后的upsert语句 -> (表名, 主键列, 每行的列数),执行时按MySQL的规则计算影响行数
+_upserts = {}
+
+# orm执行语句前调用,把orm生成的MySQL语句改写成SQLite语法: 占位符本来就是'?',LIMIT offset,count两者都支持,
+# 只需要把ON DUPLICATE KEY UPDATE改写成ON CONFLICT(主键) DO UPDATE;orm生成的INSERT主键总是最后一列
+def translate(sql):
+    m = _RE_UPSERT.match(sql)
+    if m is None:
+        return sql
+    table, columns, values, updates = m.groups()
+    columns = columns.split(',')
+    pk = columns[-1].strip()
+    updates = _RE_VALUES.sub(lambda v: 'excluded.`%s`' % v.group(1), updates)
+    sql = 'insert into `%s` (%s) values%s on conflict(%s) do update set %s' % (table, ','.join(columns), values, pk, updates)
+    if len(_upserts) >= 1024:
+        _upserts.clear()
+    _upserts[sql] = (table, pk, len(columns))
+    return sql
+
+# 根据模型生成SQLite的建表和建索引语句
+def create_table_statements(model):
+    cols = ['`%s` %s not null' % (k, model.__mappings__[k].column_type) for k in [model.__primary_key__] + model.__fields__]
+    cols.append('primary key (`%s`)' % model.__primary_key__)
+    sql = ['create table if not exists `%s` (%s)' % (model.__table__, ', '.join(cols))]
+    for idx in model.__indexes__:
+        sql.append('create %sindex if not exists `%s_%s` on `%s` (%s)' % ('unique ' if idx.unique else '', model.__table__, idx.name, model.__table__, ', '.join(map(lambda c: '`%s`' % c, idx.columns))))
+    return sql
+
+
+class _Cursor(object):
+
+    def __init__(self, conn, dict_rows):
+        self._conn = conn
+        self._dict_rows = dict_rows
+        self._cur = None
+        self._names = None
+        self.rowcount = -1
+
+    @asyncio.coroutine
+    def execute(self, sql, args=None):
+        return (yield from self._conn._run(self._execute, sql, args))
+
+    def _execute(self, sql, args):
+        args = tuple(args or ())
+        upsert = _upserts.get(sql)
+        existing = 0
+        if upsert is not None:
+            # MySQL的upsert插入的行计1,更新的行计2(值没有变化的行MySQL计0,这里仍计2);SQLite都计1,先数出已存在的行
+            table, pk, n = upsert
+            pks = args[n - 1::n]
+            existing = self._conn._db.execute('select count(*) from `%s` where %s in (%s)' % (table, pk, ', '.join('?' * len(pks))), pks).fetchone()[0]
+        self._cur = self._conn._db.execute(sql, args)
+        self.rowcount = self._cur.rowcount + existing
+        self._names = [d[0] for d in self._cur.description] if self._cur.description else None
+        return self.rowcount
+
+    def _rows(self, rows):
+        if self._dict_rows and self._names is not None:
+            names = self._names
+            return [dict(zip(names, r)) for r in rows]
+        return rows
+
+    @asyncio.coroutine
+    def fetchall(self):
+        if self._cur is None:
+            return []
+        return self._rows((yield from self._conn._run(self._cur.fetchall)))
+
+    @asyncio.coroutine
+    def fetchmany(self, size=None):
+        if self._cur is None:
+            return []
+        return self._rows((yield from self._conn._run(self._cur.fetchmany, size or 1)))
+
+    @asyncio.coroutine
+    def fetchone(self):
+        rs = yield from self.fetchmany(1)
+        return rs[0] if rs else None
+
+    @asyncio.coroutine
+    def close(self):
+        if self._cur is not None:
+            self._cur.close()
+            self._cur = None
+
+
+class Connection(object):
+
+    def __init__(self, db, loop):
+        self._db = db
+        self._loop = loop
+        self.closed = False
+
+    def _run(self, fn, *args):
+        return self._loop.run_in_executor(None, functools.partial(fn, *args))
+
+    @asyncio.coroutine
+    def cursor(self, cursor=None):
+        return _Cursor(self, bool(cursor and cursor.dict_rows))
+
+    @asyncio.coroutine
+    def begin(self):
+        yield from self._run(self._db.execute, 'begin')
+
+    @asyncio.coroutine
+    def commit(self):
+        if self._db.in_transaction:
+            yield from self._run(self._db.execute, 'commit')
+
+    @asyncio.coroutine
+    def rollback(self):
+        if self._db.in_transaction:
+            yield from self._run(self._db.execute, 'rollback')
+
+    @asyncio.coroutine
+    def ping(self, reconnect=True):
+        yield from self._run(self._db.execute, 'select 1')
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            # 语句可能还在线程池中执行(例如超过截止时间被orm取消),先中断它
+            self._db.interrupt()
+            self._db.close()
+
+
+class Pool(object):
+
+    def __init__(self, database, minsize, maxsize, loop):
+        self.database = database
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self._loop = loop
+        self._free = []
+        self._used = set()
+        self._cond = asyncio.Condition()
+        self._closed = False
+        # 共享缓存的内存数据库在最后一个连接关闭后消失,保留一个连接直到连接池关闭
+        self._keeper = self._connect()
+
+    def _connect(self):
+        if self.database == ':memory:' or '/' not in self.database and not self.database.endswith('.db'):
+            db = sqlite3.connect('file:%s?mode=memory&cache=shared' % (self.database.strip(':') or 'memory'), uri=True, isolation_level=None, check_same_thread=False)
+            db.execute('pragma read_uncommitted = true')
+        else:
+            db = sqlite3.connect(self.database, isolation_level=None, check_same_thread=False, timeout=30)
+            db.execute('pragma journal_mode = wal')
+        return db
+
+    @property
+    def size(self):
+        return len(self._free) + len(self._used)
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    @asyncio.coroutine
+    def _fill(self):
+        while self.size < self.minsize:
+            self._free.append(Connection(self._connect(), self._loop))
+
+    @asyncio.coroutine
+    def acquire(self):
+        yield from self._cond.acquire()
+        try:
+            while True:
+                if self._closed:
+                    raise RuntimeError('Cannot acquire connection after closing pool')
+                if self._free:
+                    conn = self._free.pop()
+                    break
+                if self.size < self.maxsize:
+                    conn = Connection(self._connect(), self._loop)
+                    break
+                yield from self._cond.wait()
+            self._used.add(conn)
+            return conn
+        finally:
+            self._cond.release()
+
+    def release(self, conn):
+        fut = self._loop.create_future()
+        fut.set_result(None)
+        self._used.discard(conn)
+        if not conn.closed:
+            if self._closed:
+                conn.close()
+            else:
+                if conn._db.in_transaction:
+                    logging.warning('release connection in transaction, rollback')
+                    conn._db.execute('rollback')
+                self._free.append(conn)
+        asyncio.ensure_future(self._wakeup())
+        return fut
+
+    @asyncio.coroutine
+    def _wakeup(self):
+        yield from self._cond.acquire()
+        try:
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def close(self):
+        self._closed = True
+
+    @asyncio.coroutine
+    def wait_closed(self):
+        while self._free:
+            self._free.pop().close()
+        if self._keeper is not None:
+            self._keeper.close()
+            self._keeper = None
+
+
+@asyncio.coroutine
+def create_pool(db=':memory:', minsize=1, maxsize=10, loop=None, **kw):
+    loop = loop or asyncio.get_event_loop()
+    pool = Pool(db, minsize, maxsize, loop)
+    yield from pool._fill()
+    return pool